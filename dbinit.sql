@@ -5,18 +5,48 @@ CREATE TABLE users
 --  credit NUMERIC(100000, 64) DEFAULT 0 NOT NULL
 );
 
+CREATE TABLE credit_ledger
+(
+  entry_id BIGSERIAL PRIMARY KEY,
+  user_id UUID NOT NULL,
+  amount FLOAT NOT NULL,
+  created_at TIMESTAMP DEFAULT now() NOT NULL,
+  INDEX credit_ledger_user_idx (user_id) STORING (amount),
+  CONSTRAINT fk_user_ledger_id
+      FOREIGN KEY(user_id)
+	    REFERENCES users(user_id)
+        ON DELETE CASCADE
+);
+
 CREATE TABLE stocks
 (
   item_id UUID PRIMARY KEY,
   stock INTEGER NOT NULL,
-  price FLOAT NOT NULL
+  price FLOAT NOT NULL,
 --  price NUMERIC(100000, 64) NOT NULL
+  shards INTEGER DEFAULT 0 NOT NULL
+);
+
+CREATE TABLE stock_shards
+(
+  item_id UUID NOT NULL,
+  shard INTEGER NOT NULL,
+  stock INTEGER NOT NULL,
+  updated_at TIMESTAMP DEFAULT now() NOT NULL,
+  PRIMARY KEY (item_id, shard),
+  CONSTRAINT fk_item_shard_id
+      FOREIGN KEY(item_id)
+	    REFERENCES stocks(item_id)
+        ON DELETE CASCADE
 );
 
 CREATE TABLE orders
 (
   order_id UUID PRIMARY KEY,
   user_id UUID NOT NULL,
+  total_cost FLOAT DEFAULT 0.0 NOT NULL,
+  item_count INTEGER DEFAULT 0 NOT NULL,
+  paid BOOL DEFAULT false NOT NULL,
   CONSTRAINT fk_user_order_id
       FOREIGN KEY(user_id)
 	    REFERENCES users(user_id)
@@ -28,6 +58,7 @@ CREATE TABLE carts
   id BIGSERIAL PRIMARY KEY,
   item_id UUID NOT NULL,
   order_id UUID NOT NULL,
+  price FLOAT DEFAULT 0.0 NOT NULL,
   CONSTRAINT fk_order_item_id
       FOREIGN KEY(order_id)
 	    REFERENCES orders(order_id)
@@ -51,6 +82,86 @@ CREATE TABLE payments
         ON DELETE CASCADE
 );
 
+CREATE TABLE payment_reservations
+(
+  transaction_id STRING PRIMARY KEY,
+  user_id UUID NOT NULL,
+  order_id UUID NOT NULL,
+  amount FLOAT NOT NULL,
+  status STRING DEFAULT 'prepared' NOT NULL,
+  created_at TIMESTAMP DEFAULT now() NOT NULL,
+  expires_at TIMESTAMP NOT NULL,
+  INDEX payment_reservations_expiry_idx (status, expires_at),
+  CONSTRAINT fk_user_reservation_id
+      FOREIGN KEY(user_id)
+	    REFERENCES users(user_id)
+        ON DELETE CASCADE,
+  CONSTRAINT fk_order_reservation_id
+      FOREIGN KEY(order_id)
+	    REFERENCES orders(order_id)
+        ON DELETE CASCADE
+);
+
+CREATE TABLE stock_reservations
+(
+  transaction_id STRING NOT NULL,
+  item_id UUID NOT NULL,
+  amount INTEGER NOT NULL,
+  status STRING DEFAULT 'prepared' NOT NULL,
+  created_at TIMESTAMP DEFAULT now() NOT NULL,
+  expires_at TIMESTAMP NOT NULL,
+  PRIMARY KEY (transaction_id, item_id),
+  INDEX stock_reservations_expiry_idx (status, expires_at),
+  CONSTRAINT fk_item_reservation_id
+      FOREIGN KEY(item_id)
+	    REFERENCES stocks(item_id)
+        ON DELETE CASCADE
+);
+
+CREATE TABLE checkout_log
+(
+  transaction_id STRING PRIMARY KEY,
+  order_id UUID NOT NULL,
+  mode STRING DEFAULT '2pc' NOT NULL,
+  phase STRING NOT NULL,
+  created_at TIMESTAMP DEFAULT now() NOT NULL,
+  updated_at TIMESTAMP DEFAULT now() NOT NULL,
+  INDEX checkout_log_phase_idx (phase, updated_at),
+  INDEX checkout_log_order_idx (order_id, phase)
+);
+
+CREATE TABLE saga_compensations
+(
+  transaction_id STRING NOT NULL,
+  service STRING NOT NULL,
+  path STRING NOT NULL,
+  step_path STRING NOT NULL,
+  status STRING DEFAULT 'armed' NOT NULL,
+  created_at TIMESTAMP DEFAULT now() NOT NULL,
+  updated_at TIMESTAMP DEFAULT now() NOT NULL,
+  PRIMARY KEY (transaction_id, service, path)
+);
+
+CREATE TABLE price_versions
+(
+  id INTEGER PRIMARY KEY,
+  version INTEGER DEFAULT 0 NOT NULL
+);
+
+INSERT INTO price_versions (id, version) VALUES (1, 0);
+
+CREATE TABLE idempotency_keys
+(
+  idempotency_key STRING PRIMARY KEY,
+  path STRING NOT NULL,
+  status STRING DEFAULT 'in_progress' NOT NULL,
+  response_status INTEGER,
+  response_body STRING,
+  response_mimetype STRING,
+  created_at TIMESTAMP DEFAULT now() NOT NULL,
+  expires_at TIMESTAMP NOT NULL
+);
+
 CREATE USER test
 WITH PASSWORD 'test';
 GRANT admin TO test;
\ No newline at end of file
@@ -1,41 +1,126 @@
 import os
 import sys
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.engine import Connection
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from functools import partial
+from sqlalchemy import select, bindparam, func
 from sqlalchemy_cockroachdb import run_transaction
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from werkzeug.exceptions import HTTPException
 import uuid
-import json
-import requests
-from flask import Flask, jsonify
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+from flask import Flask, jsonify, request
 
 
 # NOTE: make sure to run this app.py from this folder, so python app.py so that models are also read correctly from root
 sys.path.append("../")
-from orm_models.models import Order, Cart
+from orm_models.models import Order, Cart, CheckoutLog, SagaCompensation
+from common.db import get_engine, get_sessionmaker, pool_stats
+from common.http_client import get_client, breaker_states
+from common.cache import VersionedCache
+from common.idempotency import idempotent, HEADER as IDEMPOTENCY_HEADER
+from common.checkout_queue import get_checkout_queue, CheckoutWorkers
 
 stock_url = os.environ['STOCK_URL']
 payment_url = os.environ['PAYMENT_URL']
-datebase_url = os.environ['DATABASE_URL']
 
-app = Flask("order-service")
-
-try:
-    engine = create_engine(datebase_url, connect_args={'connect_timeout': 5})
-except Exception as e:
-    print("Failed to connect to database.")
-    print(f"{e}")
+stock_client = get_client(stock_url)
+payment_client = get_client(payment_url)
+service_clients = {'stock': stock_client, 'payment': payment_client}
 
+app = Flask("order-service")
 
-transaction_counter = 0
+orders = Order.__table__
+carts = Cart.__table__
+checkout_logs = CheckoutLog.__table__
+
+# Pre-built Core statements for the hot endpoints. SQLAlchemy caches their compiled form
+# and executing them on a plain connection skips the ORM identity map and unit of work.
+create_order_stmt = orders.insert()
+find_order_stmt = select(orders.c.user_id, orders.c.total_cost, orders.c.item_count, orders.c.paid) \
+    .where(orders.c.order_id == bindparam('order_id'))
+add_item_stmt = carts.insert()
+# The order with the quantity of each item in its cart, as one row per item. An empty
+# cart gives one row without an item, a missing order no rows at all.
+find_order_with_items_stmt = select(
+        orders.c.user_id, orders.c.total_cost, orders.c.paid,
+        carts.c.item_id, func.count(carts.c.item_id).label('quantity')
+    ) \
+    .select_from(orders.outerjoin(carts, carts.c.order_id == orders.c.order_id)) \
+    .where(orders.c.order_id == bindparam('order_id')) \
+    .group_by(orders.c.user_id, orders.c.total_cost, orders.c.paid, carts.c.item_id)
+
+# Bounded pool used to talk to the 2PC participants concurrently.
+participant_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('PARTICIPANT_POOL_SIZE', 16)))
+
+# Seconds after which a checkout that is still in progress in the coordinator log is considered in doubt.
+# Kept below PREPARED_TX_TTL of the participants, so recovery usually sends a decision before they reap.
+RECOVERY_GRACE = float(os.environ.get('RECOVERY_GRACE', 20))
+# Seconds between the recovery sweeps of a worker, and the most checkouts a sweep claims.
+RECOVERY_INTERVAL = float(os.environ.get('RECOVERY_INTERVAL', 10))
+RECOVERY_BATCH = int(os.environ.get('RECOVERY_BATCH', 100))
+
+# Phases of a checkout in the coordinator log.
+PREPARING = 'preparing'
+DECISION_PHASE = {'commit': 'committing', 'rollback': 'aborting'}
+FINAL_PHASE = {'commit': 'committed', 'rollback': 'aborted'}
+# A participant refused the decision because it had decided the transaction otherwise. Final, since
+# retrying cannot change that answer, and listed by /refused_checkouts for an operator to resolve.
+REFUSED = 'refused'
+
+# Checkout runs as 2PC ('2pc') or as a saga with compensations ('saga'),
+# can be overridden per request with the `mode` query parameter.
+CHECKOUT_MODE = os.environ.get('CHECKOUT_MODE', '2pc')
+COMPENSATION_ATTEMPTS = int(os.environ.get('COMPENSATION_ATTEMPTS', 3))
+
+# Phases of a saga checkout in the coordinator log.
+SAGA_RUNNING = 'running'
+SAGA_COMPENSATING = 'compensating'
+SAGA_COMPLETED = 'completed'
+SAGA_COMPENSATED = 'compensated'
+
+# Phases in which a checkout may still change the payment or the stock of its order.
+ACTIVE_PHASES = [PREPARING, SAGA_RUNNING, SAGA_COMPENSATING] + list(DECISION_PHASE.values())
+
+# Checkouts can run asynchronously (CHECKOUT_ASYNC or the `async` query parameter): the request
+# is queued in CHECKOUT_QUEUE ('memory' or 'redis') and CHECKOUT_WORKERS threads drain the queue.
+CHECKOUT_ASYNC = os.environ.get('CHECKOUT_ASYNC', 'false').lower() == 'true'
+CHECKOUT_QUEUE = os.environ.get('CHECKOUT_QUEUE', 'memory')
+CHECKOUT_QUEUE_SIZE = int(os.environ.get('CHECKOUT_QUEUE_SIZE', 10000))
+CHECKOUT_WORKERS = int(os.environ.get('CHECKOUT_WORKERS', 4))
+
+# Item prices are cached in-process: at most PRICE_CACHE_SIZE items for PRICE_CACHE_TTL seconds each.
+# The price version of stock is polled every PRICE_VERSION_INTERVAL seconds to drop stale prices.
+PRICE_CACHE_SIZE = int(os.environ.get('PRICE_CACHE_SIZE', 10000))
+PRICE_CACHE_TTL = float(os.environ.get('PRICE_CACHE_TTL', 60))
+PRICE_VERSION_INTERVAL = float(os.environ.get('PRICE_VERSION_INTERVAL', 1))
+
+price_cache = VersionedCache(PRICE_CACHE_SIZE, PRICE_CACHE_TTL)
+
+# Every unit in a cart is its own row, so a single bulk add is bounded per item and in total.
+MAX_ITEM_QUANTITY = int(os.environ.get('MAX_ITEM_QUANTITY', 100))
+MAX_BATCH_UNITS = int(os.environ.get('MAX_BATCH_UNITS', 1000))
+
+class CheckoutInProgressException(Exception):
+    """Exception class for handling a checkout of an order that another checkout is still working on"""
+    def __str__(self) -> str:
+         return "Checkout of order is already in progress"
 
 # Generates new transaction id.
+# Time-ordered UUID (version 7 layout): a 48 bit millisecond timestamp followed by random bits,
+# so ids are unique across workers and replicas without any coordination.
 def get_new_transaction_id():
-    global transaction_counter
-    transaction_counter += 1
-    return transaction_counter
+    value = (time.time_ns() // 1_000_000) << 80 | int.from_bytes(os.urandom(10), 'big')
+    value = value & ~(0xF << 76) | 0x7 << 76
+    value = value & ~(0x3 << 62) | 0x2 << 62
+    return str(uuid.UUID(int=value))
+
+# Exposes connection pool usage of this process, to size pools against the database connection limits.
+@app.get('/db_pool_stats')
+def db_pool_stats():
+    return jsonify(pool_stats()), 200
 
 # Catch all unhandled exceptions
 @app.errorhandler(Exception)
@@ -50,11 +135,24 @@ def handle_exception(e):
 
 
 
+# Exposes the state of the circuit breakers of all upstream services.
+@app.get('/circuit_breakers')
+def circuit_breakers():
+    return jsonify(breaker_states()), 200
+
+# Exposes hit, miss and eviction counters of the item price cache of this process.
+@app.get('/price_cache_stats')
+def price_cache_stats():
+    return jsonify(price_cache.stats()), 200
+
+
 @app.post('/create/<user_id>')
 def create_order(user_id):
     order_uuid = uuid.uuid4()
-    new_user_order = Order(order_id=order_uuid, user_id=user_id)
-    run_transaction(sessionmaker(bind=engine), lambda s: s.add(new_user_order))
+    run_transaction(
+        get_engine(),
+        lambda conn: conn.execute(create_order_stmt, {"order_id": order_uuid, "user_id": user_id})
+    )
     return jsonify(order_id=order_uuid)
 
 def remove_order_helper(session, order_id):
@@ -64,24 +162,89 @@ def remove_order_helper(session, order_id):
 def remove_order(order_id):
     try:
         run_transaction(
-            sessionmaker(bind=engine),
+            get_sessionmaker(),
             lambda s: remove_order_helper(s, order_id)
         )
         return '', 200
     except Exception:
         return "Something went wrong", 400
 
+# Removes many orders with a single delete, their carts are removed by the cascade.
+# Expects a JSON body of the form {"order_ids": [...]}.
+@app.delete('/remove_batch')
+def remove_orders():
+    order_ids = list(set(request.get_json(force=True).get('order_ids', [])))
+    try:
+        removed = run_transaction(
+            get_engine(),
+            lambda conn: conn.execute(orders.delete().where(orders.c.order_id.in_(order_ids))).rowcount
+        )
+        return jsonify(removed=removed), 200
+    except Exception:
+        return "Something went wrong", 400
+
 
-def add_item_order_helper(session, order_id, item_id):
-    new_item_order = Cart(item_id=item_id, order_id=order_id)
-    session.add(new_item_order)
+def get_prices(item_ids):
+    """Returns the {item id: price} of the given items and an error (None on success).
+    Only the items missing from the price cache are looked up in stock, with a single request.
+    """
+    prices, missing = price_cache.get_many(set(item_ids))
+    if missing:
+        resp_stock = stock_client.post("/find_batch", idempotent=True, json={"item_ids": missing})
+        if resp_stock.status_code >= 400:
+            return None, resp_stock.text
+        body = resp_stock.json()
+        fetched = {item_id: item['price'] for item_id, item in body['items'].items()}
+        price_cache.put_many(fetched, body['version'])
+        prices.update(fetched)
+    return prices, None
+
+def watch_price_version():
+    while True:
+        time.sleep(PRICE_VERSION_INTERVAL)
+        try:
+            resp_stock = stock_client.get("/price_version")
+            if resp_stock.status_code < 400:
+                price_cache.observe_version(resp_stock.json()['version'])
+        except Exception:
+            # Stock is unreachable, the TTL still bounds how stale the cached prices get.
+            pass
+
+threading.Thread(target=watch_price_version, name="price-version-watch", daemon=True).start()
+
+# The cart rows keep a snapshot of the price and the order totals are updated in the
+# same transaction, so reading an order never needs the prices of its items again.
+# Takes the {item_id: quantity} to add, all cart rows are inserted with one statement.
+def add_items_order_helper(conn, order_id, items, prices):
+    updated = conn.execute(
+        orders.update()
+        .where(orders.c.order_id == order_id)
+        .values(
+            total_cost=orders.c.total_cost + sum(prices[item_id] * quantity for item_id, quantity in items.items()),
+            item_count=orders.c.item_count + sum(items.values())
+        )
+        .returning(orders.c.order_id)
+    ).first()
+    if updated is None:
+        raise NoResultFound("No row was found when one was required")
+    conn.execute(add_item_stmt, [
+        {"item_id": item_id, "order_id": order_id, "price": prices[item_id]}
+        for item_id, quantity in items.items()
+        for _ in range(quantity)
+    ])
+
+def add_item_order_helper(conn, order_id, item_id, price):
+    add_items_order_helper(conn, order_id, {item_id: 1}, {item_id: price})
 
 @app.post('/addItem/<order_id>/<item_id>')
 def add_item(order_id, item_id):
+    prices, error = get_prices([item_id])
+    if error is not None:
+        return error, 400
     try:
         run_transaction(
-            sessionmaker(bind=engine),
-            lambda s: add_item_order_helper(s, order_id, item_id)
+            get_engine(),
+            lambda conn: add_item_order_helper(conn, order_id, item_id, prices[item_id])
         )
         return '',200
     except NoResultFound:
@@ -89,58 +252,135 @@ def add_item(order_id, item_id):
     except MultipleResultsFound:
         return "Multiple user_orders were found while one is expected", 400
 
-def remove_order_item_helper(session, order_id, item_id):
-    session.query(Cart).filter(Cart.order_id == order_id, Cart.item_id == item_id).delete()
+def read_cart_items(body):
+    """Returns the {item_id: quantity} of a bulk cart request and an error (None on success)."""
+    try:
+        items = {str(uuid.UUID(item_id)): quantity for item_id, quantity in body.get('items', {}).items()}
+    except ValueError:
+        return None, "Item ids must be UUIDs"
+    if not items or any(not isinstance(quantity, int) or quantity <= 0 for quantity in items.values()):
+        return None, "Quantities must be positive integers"
+    return items, None
+
+# Adds many items to the order in one request and one transaction.
+# Expects a JSON body of the form {"items": {item_id: quantity, ...}}.
+@app.post('/addItem_batch/<order_id>')
+def add_items(order_id):
+    items, error = read_cart_items(request.get_json(force=True))
+    if error is not None:
+        return error, 400
+    if max(items.values()) > MAX_ITEM_QUANTITY:
+        return f"At most {MAX_ITEM_QUANTITY} units of an item can be added at once", 400
+    if sum(items.values()) > MAX_BATCH_UNITS:
+        return f"At most {MAX_BATCH_UNITS} units can be added at once", 400
+    prices, error = get_prices(list(items))
+    if error is not None:
+        return error, 400
+    try:
+        run_transaction(
+            get_engine(),
+            lambda conn: add_items_order_helper(conn, order_id, items, prices)
+        )
+        return '', 200
+    except NoResultFound:
+        return "No user_order was found", 400
+
+def update_order_totals_helper(conn, order_id, removed):
+    if removed:
+        conn.execute(
+            orders.update()
+            .where(orders.c.order_id == order_id)
+            .values(
+                total_cost=orders.c.total_cost - sum(row.price for row in removed),
+                item_count=orders.c.item_count - len(removed)
+            )
+        )
+
+def remove_order_item_helper(conn, order_id, item_id):
+    removed = conn.execute(
+        carts.delete()
+        .where(carts.c.order_id == order_id, carts.c.item_id == item_id)
+        .returning(carts.c.price)
+    ).all()
+    update_order_totals_helper(conn, order_id, removed)
+
+# Takes the {item_id: quantity} to remove, at most the units in the cart are removed.
+# The rows to remove are picked first, then deleted with one statement.
+def remove_order_items_helper(conn, order_id, items):
+    cart_rows = conn.execute(
+        select(carts.c.id, carts.c.item_id)
+        .where(carts.c.order_id == order_id, carts.c.item_id.in_(list(items)))
+        .order_by(carts.c.id)
+    ).all()
+    remaining = dict(items)
+    cart_ids = []
+    for row in cart_rows:
+        if remaining[str(row.item_id)] > 0:
+            remaining[str(row.item_id)] -= 1
+            cart_ids.append(row.id)
+    if not cart_ids:
+        return
+    removed = conn.execute(
+        carts.delete()
+        .where(carts.c.id.in_(cart_ids))
+        .returning(carts.c.price)
+    ).all()
+    update_order_totals_helper(conn, order_id, removed)
 
 @app.delete('/removeItem/<order_id>/<item_id>')
 def remove_item(order_id, item_id):
     try:
         run_transaction(
-            sessionmaker(bind=engine),
-            lambda s: remove_order_item_helper(s, order_id, item_id)
+            get_engine(),
+            lambda conn: remove_order_item_helper(conn, order_id, item_id)
+        )
+        return '', 200
+    except Exception:
+        return "Something went wrong!", 400
+
+# Removes many items from the order in one request and one transaction.
+# Expects a JSON body of the form {"items": {item_id: quantity, ...}}.
+@app.delete('/removeItem_batch/<order_id>')
+def remove_items(order_id):
+    items, error = read_cart_items(request.get_json(force=True))
+    if error is not None:
+        return error, 400
+    try:
+        run_transaction(
+            get_engine(),
+            lambda conn: remove_order_items_helper(conn, order_id, items)
         )
         return '', 200
     except Exception:
         return "Something went wrong!", 400
 
-def find_order_items_helper(session, order_id):
-    order_items = session.query(Cart).filter(Cart.order_id == order_id).all()
-    return order_items
+# The order totals and the cart are read with a single query, so they always agree.
+# Used by the /find view and by the checkout, which pass their own connection.
+def find_order_helper(conn, order_id) -> dict:
+    rows = conn.execute(find_order_with_items_stmt, {"order_id": order_id}).all()
+    if not rows:
+        raise NoResultFound("No row was found when one was required")
+    quantities = {str(row.item_id): row.quantity for row in rows if row.item_id is not None}
+    return {
+        "order_id": order_id,
+        "paid": rows[0].paid,
+        "items": [item_id for item_id, quantity in quantities.items() for _ in range(quantity)],
+        "quantities": quantities,
+        "user_id": str(rows[0].user_id),
+        "total_cost": rows[0].total_cost
+    }
 
 
 @app.get('/find/<order_id>')
 def find_order(order_id):
     try:
-        ret_user_order: Order = run_transaction(
-            sessionmaker(bind=engine, expire_on_commit=False),
-            lambda s: s.query(Order).filter(Order.order_id == order_id).one()
-        )
-        ret_order_items: list[Cart] = run_transaction(
-            sessionmaker(bind=engine, expire_on_commit=False),
-            lambda s: find_order_items_helper(s, order_id)
-        )
-
-        if ret_user_order and ret_order_items:
-            resp_pay_status = requests.post(f"{payment_url}/status/{ret_user_order.user_id}/{order_id}")
-            if resp_pay_status.status_code >= 400:
-                return resp_pay_status.text, 400
-            status = resp_pay_status.json()['paid']
-            items = []
-            total_cost = 0.0
-            for order_item in ret_order_items:
-                resp_stock_price = requests.get(f"{stock_url}/find/{order_item.item_id}")
-                if resp_stock_price.status_code >= 400:
-                    return resp_stock_price.text, 400
-                stock_price = resp_stock_price.json()['price']
-                total_cost += float(stock_price)
-                items.append(order_item.item_id)
-            return jsonify(
-                order_id=order_id,
-                paid=status, 
-                items=items, 
-                user_id=ret_user_order.user_id, 
-                total_cost=total_cost
-            ), 200
+        ret_order = run_transaction(
+            get_engine(),
+            lambda conn: find_order_helper(conn, order_id)
+        )
+
+        if ret_order['items']:
+            return jsonify(**ret_order), 200
         else:
             return 'Something went wrong!', 400
     except NoResultFound:
@@ -148,6 +388,34 @@ def find_order(order_id):
     except MultipleResultsFound:
         return "Multiple user_orders were found while one is expected", 400
 
+def set_paid_helper(session, order_id, paid):
+    updated = session.execute(
+        orders.update()
+        .where(orders.c.order_id == order_id)
+        .values(paid=paid)
+        .returning(orders.c.user_id)
+    ).first()
+    if updated is None:
+        raise NoResultFound("No row was found when one was required")
+
+# Payment stays the source of truth of the paid status, this copies it into the order,
+# e.g. for orders that were paid directly through payment instead of a checkout.
+@app.post('/reconcile/<order_id>')
+def reconcile_paid(order_id):
+    try:
+        ret_user_order = run_transaction(
+            get_engine(),
+            lambda conn: conn.execute(find_order_stmt, {"order_id": order_id}).one()
+        )
+        resp_pay_status = payment_client.post(f"/status/{ret_user_order.user_id}/{order_id}", idempotent=True)
+        if resp_pay_status.status_code >= 400:
+            return resp_pay_status.text, 400
+        paid = resp_pay_status.json()['paid']
+        run_transaction(get_engine(), lambda conn: set_paid_helper(conn, order_id, paid))
+        return jsonify(order_id=order_id, paid=paid), 200
+    except NoResultFound:
+        return "No user_order was found", 400
+
 
 
 # @app.post('/checkout/<order_id>')
@@ -169,49 +437,441 @@ def find_order(order_id):
 #         return str(e), 400
 
 
+def send_concurrently(calls):
+    """Runs all (key, function, args) calls concurrently on the participant pool.
+
+    Every function returns a response. Stops waiting on the first failed call: calls
+    that have not been started yet are cancelled, the ones already in flight are awaited
+    so that a rollback or compensation can never overtake the request it undoes. Returns
+    the keys of the calls that were started and the error of the first failed call as a
+    (message, status) response (None when all calls succeeded). The status is 400 when the
+    participant refused the call and 503 when the failure was transient: the participant
+    was unreachable, failed itself or was still busy with the same request (409).
+    """
+    futures = {participant_pool.submit(function, *args): key for key, function, args in calls}
+    error = None
+    for future in as_completed(futures):
+        try:
+            response = future.result()
+            if response.status_code >= 400:
+                refused = response.status_code < 500 and response.status_code != 409
+                error = response.text, 400 if refused else 503
+        except Exception as e:
+            error = f'failure {str(e)}', 503
+        if error is not None:
+            break
+
+    if error is not None:
+        for future in futures:
+            future.cancel()
+        wait(futures)
+
+    started = {key for future, key in futures.items() if not future.cancelled()}
+    return started, error
+
+def prepare_participants(prepares):
+    """Sends all prepare requests concurrently and collects the votes.
+    Takes a list of ((service client, transaction id), path, request kwargs) and returns
+    the participants that received a prepare and the error response of the first failed vote.
+    """
+    return send_concurrently([
+        (participant, partial(participant[0].post, path, **kwargs), ())
+        for participant, path, kwargs in prepares
+    ])
+
+def end_participants(participants, status):
+    """Sends commit or rollback to all given (service client, transaction id) participants concurrently.
+    Returns whether every participant acknowledged the decision, and whether any of them refused it
+    (409) because it had decided the transaction otherwise.
+    """
+    futures = [
+        participant_pool.submit(client.post, f"/endTransaction/{transaction_id}/{status}", idempotent=True)
+        for client, transaction_id in participants
+    ]
+    wait(futures)
+    responses = [future.result() for future in futures if future.exception() is None]
+    acknowledged = len(responses) == len(futures) and all(response.status_code < 400 for response in responses)
+    refused = any(response.status_code == 409 for response in responses)
+    return acknowledged, refused
+
+def set_checkout_phase_helper(session, transaction_id, phase):
+    session.query(CheckoutLog).filter(CheckoutLog.transaction_id == transaction_id).update({CheckoutLog.phase: phase})
+
+def mark_order_paid_helper(session, transaction_id, paid=True):
+    session.execute(
+        orders.update()
+        .where(orders.c.order_id == select(checkout_logs.c.order_id)
+               .where(checkout_logs.c.transaction_id == transaction_id)
+               .scalar_subquery())
+        .values(paid=paid)
+    )
+
+# Returns the decision that holds. A participant whose reservation expired takes the rollback
+# decision in the coordinator log itself (see common/reaper.py of payment and stock), so a
+# commit is only decided for a checkout that is still preparing, otherwise the rollback stands.
+def decide_checkout_helper(session, transaction_id, decision):
+    decided = session.query(CheckoutLog).filter(
+        CheckoutLog.transaction_id == transaction_id,
+        CheckoutLog.phase.in_([PREPARING, DECISION_PHASE[decision]])
+    ).update({CheckoutLog.phase: DECISION_PHASE[decision]}, synchronize_session=False)
+    if not decided:
+        return 'rollback'
+    if decision == 'commit':
+        # The order counts as paid from the moment the commit decision is durable.
+        mark_order_paid_helper(session, transaction_id)
+    return decision
+
+def refuse_checkout_helper(session, transaction_id, decision):
+    set_checkout_phase_helper(session, transaction_id, REFUSED)
+    if decision == 'commit':
+        # Not every participant committed, so the order does not count as paid after all.
+        mark_order_paid_helper(session, transaction_id, paid=False)
+
+def finish_checkout(transaction_id, decision, participants):
+    """Makes the decision durable in the coordinator log, then sends it to the participants.
+    The checkout is only marked as finished once all participants acknowledged the decision,
+    or as refused once one of them refused it. Returns the decision that was taken, or REFUSED.
+    """
+    decision = run_transaction(
+        get_sessionmaker(),
+        lambda s: decide_checkout_helper(s, transaction_id, decision)
+    )
+    acknowledged, refused = end_participants(participants, decision)
+    if refused:
+        print(f"ALERT: a participant refused the {decision} of checkout {transaction_id}")
+        run_transaction(
+            get_sessionmaker(),
+            lambda s: refuse_checkout_helper(s, transaction_id, decision)
+        )
+        return REFUSED
+    if acknowledged:
+        run_transaction(
+            get_sessionmaker(),
+            lambda s: set_checkout_phase_helper(s, transaction_id, FINAL_PHASE[decision])
+        )
+    return decision
+
+def refused_checkouts_helper(session):
+    refused = session.query(CheckoutLog).filter(CheckoutLog.phase == REFUSED) \
+        .order_by(CheckoutLog.updated_at.desc()).limit(100).all()
+    return [log.to_dict() for log in refused]
+
+# Lists the checkouts whose decision a participant refused, they need an operator to resolve them.
+@app.get('/refused_checkouts')
+def refused_checkouts():
+    return jsonify(checkouts=run_transaction(get_sessionmaker(), refused_checkouts_helper)), 200
+
+
+def is_async_checkout():
+    return request.args.get('async', str(CHECKOUT_ASYNC)).lower() == 'true'
+
+def derive_checkout_key(order_id):
+    # An accepted async checkout can still fail, so its 202 must not block a real retry.
+    return None if is_async_checkout() else order_id
+
+# Retries are answered from the stored response: with an Idempotency-Key header any
+# response is replayed, without one the order id serves as key and only a success is.
 @app.post('/checkout/<order_id>')
+@idempotent('order', derive_key=derive_checkout_key)
 def checkout(order_id):
+    mode = request.args.get('mode', CHECKOUT_MODE)
+    if mode not in ('2pc', 'saga'):
+        return 'Unknown checkout mode: ' + mode, 400
+    if is_async_checkout():
+        job_id = get_new_transaction_id()
+        if not checkout_queue.enqueue(job_id, {"order_id": order_id, "mode": mode}):
+            return 'Checkout queue is full', 503
+        return jsonify(job_id=job_id, status_url=f"/checkout_status/{job_id}"), 202
+    return run_checkout(order_id, mode)
+
+def run_checkout(order_id, mode):
     print("Checkout started")
     try:
-        payment_transaction_id = get_new_transaction_id()
-
-        ret_order = json.loads(find_order(order_id)[0].get_data(as_text=True))
+        ret_order = run_transaction(
+            get_engine(),
+            lambda conn: find_order_helper(conn, order_id)
+        )
         status_before = ret_order['paid']
 
-        stock_transaction_id = get_new_transaction_id()
-
         if status_before:
             # Order is already payed.
             return 'transaction already checked out', 400
-        else:
-            pay_status = requests.post(f"{payment_url}/prepare_pay/{payment_transaction_id}/{ret_order['user_id']}/{ret_order['order_id']}/{ret_order['total_cost']}")
-            
-            if pay_status.status_code >= 400:
-                return pay_status.text, 400      
-
-            stock_subtract_status_list = []
-            for idx, item_id in enumerate(ret_order['items']):
-                stock_subtract_status_list.append(requests.post(f"{stock_url}/prepare_subtract/{stock_transaction_id}/{item_id}/1"))
-                if stock_subtract_status_list[idx].status_code >= 400:
-                    return stock_subtract_status_list[idx].text, 400
-
-            all_stock_requests = all([x.status_code == 200 for x in stock_subtract_status_list])
-            
-            # Check if both services are ready to commit.
-            if pay_status and all_stock_requests:
-                requests.post(f"{payment_url}/endTransaction/{payment_transaction_id}/commit")
-                requests.post(f"{stock_url}/endTransaction/{stock_transaction_id}/commit")
-            elif not pay_status:
-                # Payment went wrong.
-                requests.post(f"{payment_url}/endTransaction/{payment_transaction_id}/rollback")
-            else:
-                # Reducing the stock went wrong.
-                requests.post(f"{stock_url}/endTransaction/{stock_transaction_id}/rollback")
-        print("Checkout ended")    
-        return 'success', 200
+        if not ret_order['items']:
+            return 'Order has no items', 400
+
+        if mode == 'saga':
+            return saga_checkout(order_id, ret_order)
+        return two_phase_checkout(order_id, ret_order)
+    except CheckoutInProgressException as e:
+        return str(e), 409
+    except NoResultFound:
+        return "No user_order was found", 400
     except Exception as e:
-        # add rollback 
-        return f'failure {str(e)}', 400
+        # Transient, e.g. the database is unreachable, so a retry must run the checkout again.
+        return f'failure {str(e)}', 503
+
+def run_queued_checkout(payload):
+    # Workers run outside of any request, building the response needs an app context.
+    with app.app_context():
+        response = app.make_response(run_checkout(payload["order_id"], payload["mode"]))
+        return response.status_code, response.get_data(as_text=True)
+
+checkout_queue = get_checkout_queue(CHECKOUT_QUEUE, CHECKOUT_QUEUE_SIZE)
+checkout_workers = CheckoutWorkers(checkout_queue, run_queued_checkout, CHECKOUT_WORKERS)
+checkout_workers.start()
+
+# Outcome of an async checkout: queued, running, succeeded or failed with the checkout response.
+@app.get('/checkout_status/<job_id>')
+def checkout_status(job_id):
+    status = checkout_queue.get_status(job_id)
+    if status is None:
+        return "No checkout job was found", 400
+    return jsonify(job_id=job_id, **status), 200
+
+# Only one checkout of an order can be active at a time, so two checkouts never both take the stock
+# and one never compensates the payment of the other. Under serializable isolation two concurrent
+# first checkouts cannot both see no active checkout: one of them is retried and then sees the other.
+def start_checkout_helper(session, transaction_id, order_id, mode, phase):
+    active = session.query(CheckoutLog.transaction_id).filter(
+        CheckoutLog.order_id == order_id,
+        CheckoutLog.phase.in_(ACTIVE_PHASES)
+    ).first()
+    if active:
+        raise CheckoutInProgressException()
+    session.add(CheckoutLog(transaction_id=transaction_id, order_id=order_id, mode=mode, phase=phase))
+
+def two_phase_checkout(order_id, ret_order):
+    transaction_id = get_new_transaction_id()
+    run_transaction(
+        get_sessionmaker(),
+        lambda s: start_checkout_helper(s, transaction_id, order_id, '2pc', PREPARING)
+    )
+    # The whole cart is reserved with a single stock request.
+    prepares = [
+        (
+            (payment_client, transaction_id),
+            f"/prepare_pay/{transaction_id}/{ret_order['user_id']}/{ret_order['order_id']}/{ret_order['total_cost']}",
+            {}
+        ),
+        (
+            (stock_client, transaction_id),
+            f"/prepare_subtract_batch/{transaction_id}",
+            {"json": {"items": ret_order['quantities']}}
+        )
+    ]
+
+    prepared, error = prepare_participants(prepares)
+
+    # Check if all services are ready to commit.
+    if error is not None:
+        finish_checkout(transaction_id, 'rollback', prepared)
+        return error
+    decision = finish_checkout(transaction_id, 'commit', prepared)
+    if decision == REFUSED:
+        return 'Checkout was refused by a participant', 400
+    if decision != 'commit':
+        return 'Checkout timed out and was rolled back', 503
+    print("Checkout ended")
+    return 'success', 200
+
+
+def saga_key(transaction_id, path):
+    """Idempotency key of a saga request, the same for every retry of it."""
+    return f"{transaction_id}:{path}"
+
+def step_refused(response):
+    # Answered without effect. A 409 is a duplicate of a request still running, its outcome is unknown.
+    return 400 <= response.status_code < 500 and response.status_code != 409
+
+def arm_compensation_helper(session, transaction_id, service, path, step_path):
+    session.add(SagaCompensation(transaction_id=transaction_id, service=service, path=path, step_path=step_path))
+
+def disarm_compensation_helper(session, transaction_id, service, path):
+    session.query(SagaCompensation).filter(
+        SagaCompensation.transaction_id == transaction_id,
+        SagaCompensation.service == service,
+        SagaCompensation.path == path
+    ).delete()
+
+def saga_step(transaction_id, service, path, compensation_path):
+    """Runs one step of a saga as a short local transaction of the participant.
+    Its compensation is armed before the step is sent, so that a crash in between cannot
+    lose it, and disarmed again when the participant refused the step.
+    The step carries an idempotency key, so it is safe to retry.
+    """
+    run_transaction(
+        get_sessionmaker(),
+        lambda s: arm_compensation_helper(s, transaction_id, service, compensation_path, path)
+    )
+    response = service_clients[service].post(
+        path,
+        idempotent=True,
+        headers={IDEMPOTENCY_HEADER: saga_key(transaction_id, path)}
+    )
+    if step_refused(response):
+        run_transaction(
+            get_sessionmaker(),
+            lambda s: disarm_compensation_helper(s, transaction_id, service, compensation_path)
+        )
+    return response
+
+def pending_compensations_helper(session, transaction_id):
+    compensations = session.query(SagaCompensation).filter(
+        SagaCompensation.transaction_id == transaction_id,
+        SagaCompensation.status.in_(['armed', 'pending'])
+    ).all()
+    for compensation in compensations:
+        compensation.status = 'pending'
+    return [(compensation.service, compensation.path, compensation.step_path) for compensation in compensations]
+
+def set_compensation_done_helper(session, transaction_id, service, path):
+    session.query(SagaCompensation).filter(
+        SagaCompensation.transaction_id == transaction_id,
+        SagaCompensation.service == service,
+        SagaCompensation.path == path
+    ).update({SagaCompensation.status: 'done'})
+
+def compensate(transaction_id, service, path, step_path):
+    """Sends a compensation, retrying it a few times. Returns whether it succeeded.
+    The step is replayed first with its idempotency key: a step that ran is answered from
+    the stored response and one that never arrived runs now, so its outcome is known and
+    a step that was refused is never undone.
+    """
+    client = service_clients[service]
+    for attempt in range(COMPENSATION_ATTEMPTS):
+        try:
+            step = client.post(step_path, idempotent=True, headers={IDEMPOTENCY_HEADER: saga_key(transaction_id, step_path)})
+            if step.status_code < 400:
+                response = client.post(path, idempotent=True, headers={IDEMPOTENCY_HEADER: saga_key(transaction_id, path)})
+                undone = response.status_code < 400
+            else:
+                # Nothing to undo when the step was refused.
+                undone = step_refused(step)
+            if undone:
+                run_transaction(
+                    get_sessionmaker(),
+                    lambda s: set_compensation_done_helper(s, transaction_id, service, path)
+                )
+                return True
+        except Exception:
+            pass
+        time.sleep(0.1 * 2 ** attempt)
+    return False
+
+def compensate_saga(transaction_id):
+    """Runs all stored compensations of a failed saga concurrently.
+    The saga is marked as compensated once all of them succeeded, otherwise the
+    remaining ones stay pending and are retried by the recovery sweep.
+    """
+    run_transaction(
+        get_sessionmaker(),
+        lambda s: set_checkout_phase_helper(s, transaction_id, SAGA_COMPENSATING)
+    )
+    compensations = run_transaction(
+        get_sessionmaker(),
+        lambda s: pending_compensations_helper(s, transaction_id)
+    )
+    futures = [
+        participant_pool.submit(compensate, transaction_id, service, path, step_path)
+        for service, path, step_path in compensations
+    ]
+    wait(futures)
+    if all(future.result() for future in futures):
+        run_transaction(
+            get_sessionmaker(),
+            lambda s: set_checkout_phase_helper(s, transaction_id, SAGA_COMPENSATED)
+        )
+
+def complete_saga_helper(session, transaction_id):
+    set_checkout_phase_helper(session, transaction_id, SAGA_COMPLETED)
+    mark_order_paid_helper(session, transaction_id)
+    session.query(SagaCompensation).filter(SagaCompensation.transaction_id == transaction_id).delete()
+
+def saga_checkout(order_id, ret_order):
+    """Checkout as a saga: payment and stock subtraction run as short local transactions
+    of the participants, when one of them fails the ones that succeeded are compensated.
+    """
+    transaction_id = get_new_transaction_id()
+    run_transaction(
+        get_sessionmaker(),
+        lambda s: start_checkout_helper(s, transaction_id, order_id, 'saga', SAGA_RUNNING)
+    )
+    steps = [(
+        ('payment', transaction_id),
+        saga_step,
+        (
+            transaction_id,
+            'payment',
+            f"/pay/{ret_order['user_id']}/{ret_order['order_id']}/{ret_order['total_cost']}",
+            f"/cancel/{ret_order['user_id']}/{ret_order['order_id']}"
+        )
+    )]
+    for item_id, amount in ret_order['quantities'].items():
+        steps.append((
+            ('stock', item_id),
+            saga_step,
+            (transaction_id, 'stock', f"/subtract/{item_id}/{amount}", f"/add/{item_id}/{amount}")
+        ))
+
+    _, error = send_concurrently(steps)
+
+    if error is not None:
+        compensate_saga(transaction_id)
+        return error
+    run_transaction(get_sessionmaker(), lambda s: complete_saga_helper(s, transaction_id))
+    print("Checkout ended")
+    return 'success', 200
+
+
+def claim_in_doubt_checkouts_helper(session):
+    """Claims the checkouts that made no progress for RECOVERY_GRACE seconds.
+    Claiming bumps their updated_at, which leases them to this worker: other workers skip
+    them until the lease ran out without progress, e.g. because this worker crashed too.
+    """
+    in_doubt = select(checkout_logs.c.transaction_id).where(
+        checkout_logs.c.phase.in_(ACTIVE_PHASES),
+        checkout_logs.c.updated_at < datetime.utcnow() - timedelta(seconds=RECOVERY_GRACE)
+    ).limit(RECOVERY_BATCH)
+    return session.execute(
+        checkout_logs.update()
+        .where(checkout_logs.c.transaction_id.in_(in_doubt))
+        .values(updated_at=func.now())
+        .returning(checkout_logs.c.transaction_id, checkout_logs.c.mode, checkout_logs.c.phase)
+    ).all()
+
+def recover_checkouts():
+    """Finishes the checkouts left in doubt by a crashed coordinator.
+    Undecided checkouts are aborted, decided ones get their decision sent again
+    and sagas that did not complete get their pending compensations retried.
+    """
+    try:
+        in_doubt = run_transaction(get_sessionmaker(), claim_in_doubt_checkouts_helper)
+    except Exception:
+        traceback.print_exc()
+        return
+    for log in in_doubt:
+        try:
+            if log.mode == 'saga':
+                # A saga that did not complete is compensated.
+                compensate_saga(log.transaction_id)
+                continue
+            decision = 'commit' if log.phase == DECISION_PHASE['commit'] else 'rollback'
+            finish_checkout(
+                log.transaction_id,
+                decision,
+                [(payment_client, log.transaction_id), (stock_client, log.transaction_id)]
+            )
+        except Exception:
+            traceback.print_exc()
+
+def recover_checkouts_periodically():
+    while True:
+        recover_checkouts()
+        time.sleep(RECOVERY_INTERVAL)
+
+# Every worker sweeps periodically, in the background so that it can serve requests meanwhile.
+# A checkout that still fails to finish, e.g. with a participant down, is retried by a later sweep.
+threading.Thread(target=recover_checkouts_periodically, name="checkout-recovery", daemon=True).start()
 
 
 @app.post('/endTransaction/<transaction_id>/<status>')
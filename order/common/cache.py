@@ -0,0 +1,73 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class VersionedCache:
+    """Bounded in-process cache with per-entry TTL and LRU eviction.
+
+    The cache follows a version published by the owner of the data: when a newer
+    version is observed every entry is dropped, and values read under an older version
+    than the current one are not stored, so an invalidation can never be overwritten
+    by a lookup that was in flight while it happened.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = None
+        # key -> (value, monotonic expiry), least recently used first
+        self.entries = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+        self.lock = threading.Lock()
+
+    def get_many(self, keys):
+        """Returns the cached {key: value} of the given keys and the list of keys that missed."""
+        now = time.monotonic()
+        found = {}
+        missing = []
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None and entry[1] <= now:
+                    del self.entries[key]
+                    self.counters["expirations"] += 1
+                    entry = None
+                if entry is None:
+                    self.counters["misses"] += 1
+                    missing.append(key)
+                else:
+                    self.entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    found[key] = entry[0]
+        return found, missing
+
+    def put_many(self, values, version):
+        """Stores the {key: value} that were read under the given version."""
+        expires = time.monotonic() + self.ttl
+        with self.lock:
+            self._observe(version)
+            if version != self.version:
+                return
+            for key, value in values.items():
+                self.entries[key] = (value, expires)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def observe_version(self, version):
+        """Drops all entries if the given version is newer than the cached one."""
+        with self.lock:
+            self._observe(version)
+
+    def _observe(self, version):
+        if self.version is None or version > self.version:
+            if self.version is not None:
+                self.entries.clear()
+                self.counters["invalidations"] += 1
+            self.version = version
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, size=len(self.entries), maxsize=self.maxsize, version=self.version)
@@ -0,0 +1,264 @@
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+
+# Seconds the outcome of a checkout job can be polled.
+JOB_STATUS_TTL = int(os.environ.get('CHECKOUT_JOB_STATUS_TTL', 3600))
+# Seconds without a heartbeat after which a process counts as dead and its jobs are recovered.
+WORKER_TTL = int(os.environ.get('CHECKOUT_WORKER_TTL', 30))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+class MemoryCheckoutQueue:
+    """In-process checkout queue for local runs.
+
+    Jobs and their status live in the worker process that accepted them, so with more
+    than one gunicorn worker the status has to be polled from that same worker.
+    """
+
+    def __init__(self, maxsize):
+        self.jobs = queue.Queue(maxsize=maxsize)
+        self.statuses = {}
+        self.lock = threading.Lock()
+
+    def enqueue(self, job_id, payload) -> bool:
+        self.set_status(job_id, {"status": QUEUED})
+        try:
+            self.jobs.put_nowait((job_id, payload))
+            return True
+        except queue.Full:
+            with self.lock:
+                self.statuses.pop(job_id, None)
+            return False
+
+    def dequeue(self, timeout):
+        try:
+            return self.jobs.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def done(self, job_id):
+        pass
+
+    def heartbeat(self):
+        # Jobs die with the process that holds them, there is nothing left to recover.
+        pass
+
+    def set_status(self, job_id, status):
+        with self.lock:
+            self.statuses[job_id] = (status, time.monotonic() + JOB_STATUS_TTL)
+            now = time.monotonic()
+            for expired in [key for key, (_, deadline) in self.statuses.items() if deadline < now]:
+                del self.statuses[expired]
+
+    def get_status(self, job_id):
+        with self.lock:
+            entry = self.statuses.get(job_id)
+            return entry[0] if entry else None
+
+    def size(self):
+        return self.jobs.qsize()
+
+
+# KEYS: queue, status  ARGV: maxsize, queued status, status ttl, job
+# Checks the size and pushes in one step, so concurrent enqueues cannot overshoot maxsize.
+ENQUEUE = """
+if redis.call('LLEN', KEYS[1]) >= tonumber(ARGV[1]) then return 0 end
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+redis.call('LPUSH', KEYS[1], ARGV[4])
+return 1
+"""
+
+# KEYS: processing list, heartbeat, queue  ARGV: status key prefix, failed status, status ttl
+# Recovers the jobs of a dead process: jobs it took but never started go back to the head of
+# the queue, jobs it was running are failed, since they may have been partly carried out.
+# Does nothing while the process is alive. Reads the status keys of the jobs, which are only
+# known from the list, so like the stock scripts it is meant for a single Redis server.
+RECOVER = """
+if redis.call('EXISTS', KEYS[2]) == 1 then return 0 end
+local jobs = redis.call('LRANGE', KEYS[1], 0, -1)
+for _, job in ipairs(jobs) do
+    local status_key = ARGV[1] .. cjson.decode(job)['job_id']
+    local status = redis.call('GET', status_key)
+    if status then
+        status = cjson.decode(status)['status']
+        if status == 'queued' then
+            redis.call('RPUSH', KEYS[3], job)
+        elseif status == 'running' then
+            redis.call('SET', status_key, ARGV[2], 'EX', ARGV[3])
+        end
+    end
+end
+redis.call('DEL', KEYS[1])
+return #jobs
+"""
+
+
+class RedisCheckoutQueue:
+    """Checkout queue in Redis, shared by all workers and replicas of the order service.
+
+    A job is moved atomically from the queue into a processing list of the taking process
+    and only removed from there once its outcome is stored. Every process keeps a heartbeat;
+    the processing lists of processes whose heartbeat expired are recovered on startup and
+    then regularly, so a job is never lost with the process that took it.
+    """
+
+    QUEUE_KEY = 'checkout:queue'
+    STATUS_KEY = 'checkout:status:{}'
+    PROCESSING_KEY = 'checkout:processing:{}'
+    HEARTBEAT_KEY = 'checkout:heartbeat:{}'
+
+    def __init__(self, maxsize):
+        # Only needed for this backend, so local runs work without the package.
+        import redis
+        self.maxsize = maxsize
+        self.db = redis.Redis(
+            host=os.environ.get('REDIS_HOST', 'localhost'),
+            port=int(os.environ.get('REDIS_PORT', 6379)),
+            password=os.environ.get('REDIS_PASSWORD'),
+            db=int(os.environ.get('REDIS_DB', 0))
+        )
+        self.enqueue_script = self.db.register_script(ENQUEUE)
+        self.recover_script = self.db.register_script(RECOVER)
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.pid = None
+
+    def worker_id(self):
+        # A fresh id per process, also after a fork or a restart that reuses the pid.
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.id = uuid.uuid4().hex
+        return self.id
+
+    def heartbeat(self):
+        """Keeps this process alive in Redis and recovers the jobs of dead ones."""
+        self.db.set(self.HEARTBEAT_KEY.format(self.worker_id()), 1, ex=WORKER_TTL)
+        self.recover()
+
+    def enqueue(self, job_id, payload) -> bool:
+        return bool(self.enqueue_script(
+            keys=[self.QUEUE_KEY, self.STATUS_KEY.format(job_id)],
+            args=[self.maxsize, json.dumps({"status": QUEUED}), JOB_STATUS_TTL,
+                  json.dumps({"job_id": job_id, "payload": payload})]
+        ))
+
+    def dequeue(self, timeout):
+        item = self.db.blmove(
+            self.QUEUE_KEY, self.PROCESSING_KEY.format(self.worker_id()),
+            max(1, int(timeout)), src='RIGHT', dest='LEFT'
+        )
+        if item is None:
+            return None
+        job = json.loads(item)
+        with self.lock:
+            self.in_flight[job["job_id"]] = item
+        return job["job_id"], job["payload"]
+
+    def done(self, job_id):
+        """Removes the job from the processing list, once its outcome is stored."""
+        with self.lock:
+            item = self.in_flight.pop(job_id, None)
+        if item is not None:
+            self.db.lrem(self.PROCESSING_KEY.format(self.worker_id()), 1, item)
+
+    def recover(self):
+        failed = json.dumps({
+            "status": FAILED,
+            "status_code": 503,
+            "response": "The checkout worker stopped while running the job, check the order before retrying"
+        })
+        prefix = self.PROCESSING_KEY.format('')
+        for key in self.db.scan_iter(match=prefix + '*'):
+            worker_id = key.decode()[len(prefix):]
+            if worker_id == self.worker_id():
+                continue
+            self.recover_script(
+                keys=[key, self.HEARTBEAT_KEY.format(worker_id), self.QUEUE_KEY],
+                args=[self.STATUS_KEY.format(''), failed, JOB_STATUS_TTL]
+            )
+
+    def set_status(self, job_id, status):
+        self.db.set(self.STATUS_KEY.format(job_id), json.dumps(status), ex=JOB_STATUS_TTL)
+
+    def get_status(self, job_id):
+        status = self.db.get(self.STATUS_KEY.format(job_id))
+        return json.loads(status) if status is not None else None
+
+    def size(self):
+        return self.db.llen(self.QUEUE_KEY)
+
+
+backends = {'memory': MemoryCheckoutQueue, 'redis': RedisCheckoutQueue}
+
+def get_checkout_queue(backend, maxsize):
+    return backends[backend](maxsize)
+
+
+class CheckoutWorkers:
+    """Fixed pool of threads that drain the checkout queue.
+
+    The pool size bounds how many checkouts run at the same time, independent of how
+    many requests the web workers accept. `handler(payload)` runs one checkout and
+    returns its (status code, body).
+    """
+
+    def __init__(self, checkout_queue, handler, concurrency):
+        self.queue = checkout_queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self.threads = []
+
+    def start(self):
+        if not self.threads:
+            # Announces this process before its workers take any job, and recovers the
+            # jobs of processes that died. Its own thread, so long checkouts cannot delay it.
+            try:
+                self.queue.heartbeat()
+            except Exception:
+                traceback.print_exc()
+            heartbeat = threading.Thread(target=self._heartbeat, name="checkout-heartbeat", daemon=True)
+            heartbeat.start()
+        for number in range(self.concurrency - len(self.threads)):
+            thread = threading.Thread(target=self._run, name=f"checkout-worker-{number}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(WORKER_TTL / 3)
+            try:
+                self.queue.heartbeat()
+            except Exception:
+                traceback.print_exc()
+
+    def _run(self):
+        while True:
+            try:
+                job = self.queue.dequeue(timeout=1)
+                if job is None:
+                    continue
+                job_id, payload = job
+                self.queue.set_status(job_id, {"status": RUNNING})
+                try:
+                    status_code, body = self.handler(payload)
+                except Exception as e:
+                    status_code, body = 500, f'failure {str(e)}'
+                self.queue.set_status(job_id, {
+                    "status": SUCCEEDED if status_code < 400 else FAILED,
+                    "status_code": status_code,
+                    "response": body
+                })
+                self.queue.done(job_id)
+            except Exception:
+                # e.g. the queue backend is unreachable, back off before polling again.
+                traceback.print_exc()
+                time.sleep(1)
@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+# Connection pool settings, size them against the connection limits of CockroachDB:
+# every gunicorn worker of every replica gets a pool of its own.
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that measures how long requests wait to check out a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            with self.stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self.stats_lock:
+                self.checkouts += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+
+
+engine = None
+engine_pid = None
+sessionmakers = {}
+lock = threading.Lock()
+
+def get_engine():
+    """Returns the engine of this process.
+
+    The engine is built lazily and rebuilt after a fork, so gunicorn workers never
+    share pooled connections with their parent or with each other. DATABASE_URL is
+    only read here, so services that keep their data elsewhere can start without it.
+    """
+    global engine, engine_pid
+    if engine is None or engine_pid != os.getpid():
+        with lock:
+            if engine is None or engine_pid != os.getpid():
+                if engine is not None:
+                    # Leave the connections of the parent process alone.
+                    engine.dispose(close=False)
+                sessionmakers.clear()
+                engine = create_engine(
+                    os.environ['DATABASE_URL'],
+                    connect_args={'connect_timeout': 5},
+                    poolclass=TimedQueuePool,
+                    pool_size=POOL_SIZE,
+                    max_overflow=MAX_OVERFLOW,
+                    pool_timeout=POOL_TIMEOUT,
+                    pool_recycle=POOL_RECYCLE,
+                    pool_pre_ping=POOL_PRE_PING
+                )
+                engine_pid = os.getpid()
+    return engine
+
+def get_sessionmaker(expire_on_commit=True):
+    """Returns the cached session factory of this process."""
+    bind = get_engine()
+    factory = sessionmakers.get(expire_on_commit)
+    if factory is None:
+        factory = sessionmakers[expire_on_commit] = sessionmaker(bind=bind, expire_on_commit=expire_on_commit)
+    return factory
+
+def pool_stats():
+    pool = get_engine().pool
+    capacity = pool.size() + max(pool._max_overflow, 0)
+    with pool.stats_lock:
+        return {
+            "size": pool.size(),
+            "max_overflow": pool._max_overflow,
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "saturation": pool.checkedout() / capacity if capacity else 1.0,
+            "checkouts": pool.checkouts,
+            "timeouts": pool.timeouts,
+            "wait_avg_ms": 1000 * pool.wait_total / pool.checkouts if pool.checkouts else 0.0,
+            "wait_max_ms": 1000 * pool.wait_max
+        }
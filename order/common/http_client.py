@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# All settings can be tuned per deployment through the environment.
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 2))
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 10))
+POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 32))
+MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 2))
+RETRY_BACKOFF = float(os.environ.get('HTTP_RETRY_BACKOFF', 0.05))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 5))
+
+
+class CircuitOpenException(Exception):
+    """Exception class for requests rejected by an open circuit breaker"""
+    def __init__(self, upstream):
+        self.upstream = upstream
+
+    def __str__(self) -> str:
+        return f"Circuit breaker for {self.upstream} is open"
+
+
+class CircuitBreaker:
+    """Per-upstream circuit breaker.
+
+    Opens after `failure_threshold` consecutive failures (connection errors, timeouts
+    and 5xx responses) and rejects requests until `reset_timeout` seconds have passed.
+    Then a single trial request is let through (half open): a success closes the
+    breaker again, a failure re-opens it.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = CircuitBreaker.HALF_OPEN
+                self.trial_in_flight = False
+            if self.state == CircuitBreaker.HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time.monotonic()
+
+    def to_dict(self):
+        with self.lock:
+            return {"state": self.state, "failures": self.failures}
+
+
+class ServiceClient:
+    """HTTP client for a single upstream service.
+
+    Keeps a keep-alive connection pool to the upstream, applies connect/read timeouts
+    to every call, retries idempotent calls a bounded number of times and guards the
+    upstream with a circuit breaker.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.breaker = CircuitBreaker()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, path, **kwargs) -> requests.Response:
+        return self.request('GET', path, idempotent=True, **kwargs)
+
+    def post(self, path, idempotent=False, **kwargs) -> requests.Response:
+        return self.request('POST', path, idempotent=idempotent, **kwargs)
+
+    def delete(self, path, **kwargs) -> requests.Response:
+        return self.request('DELETE', path, idempotent=True, **kwargs)
+
+    def request(self, method, path, idempotent=False, **kwargs) -> requests.Response:
+        # Only calls that are safe to repeat are retried, others get a single attempt.
+        attempts = 1 + (MAX_RETRIES if idempotent else 0)
+        for attempt in range(attempts):
+            if not self.breaker.allow_request():
+                raise CircuitOpenException(self.base_url)
+            try:
+                response = self.session.request(
+                    method,
+                    f"{self.base_url}{path}",
+                    timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                    **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                self.breaker.record_failure()
+                if attempt + 1 == attempts:
+                    raise
+            else:
+                if response.status_code < 500:
+                    self.breaker.record_success()
+                    return response
+                self.breaker.record_failure()
+                if attempt + 1 == attempts:
+                    return response
+            time.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+
+clients = {}
+
+def get_client(base_url) -> ServiceClient:
+    """Returns the shared client for the given upstream, creating it on first use."""
+    if base_url not in clients:
+        clients[base_url] = ServiceClient(base_url)
+    return clients[base_url]
+
+def breaker_states():
+    return {base_url: client.breaker.to_dict() for base_url, client in clients.items()}
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, Boolean, ForeignKey, Numeric
+from sqlalchemy import Column, Integer, Boolean, ForeignKey, Numeric, String, DateTime, func
 from sqlalchemy.dialects.postgresql import UUID, FLOAT
 from sqlalchemy.orm import declarative_base, relationship
 
@@ -57,8 +57,27 @@ class User(Base):
     def to_dict(self):
        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
+class CreditEntry(Base):
+    """The CreditEntry class corresponds to the "credit_ledger" database table.
+    Credit (positive) or debit (negative) of a user that is not folded into users.credit yet.
+    """
+    __tablename__ = 'credit_ledger'
+
+    entry_id = Column(Integer, autoincrement=True, primary_key=True)
+    user_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey('users.user_id', ondelete="CASCADE"),
+        nullable=False
+    )
+    amount = Column(FLOAT(precision=64, decimal_return_scale=None), nullable=False)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    def to_dict(self):
+       return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
 class Order(Base):
     """The Order class corresponds to the "orders" database table.
+    Keeps the running total and item count of its cart, maintained by every cart change.
     """
     __tablename__ = 'orders'
 
@@ -68,7 +87,10 @@ class Order(Base):
         ForeignKey('users.user_id', ondelete="CASCADE"), 
         nullable=False
     )
-    # paid = Column(Boolean, nullable=False, default=False)
+    total_cost = Column(FLOAT(precision=64, decimal_return_scale=None), nullable=False, default=0.0)
+    item_count = Column(Integer, nullable=False, default=0)
+    # Set in the same transaction that commits the checkout of the order.
+    paid = Column(Boolean, nullable=False, default=False)
     fk_item_ids = relationship(
         "Cart",
         # cascade="all, delete",
@@ -99,6 +121,8 @@ class Cart(Base):
         ForeignKey('orders.order_id', ondelete="CASCADE"), 
         nullable=False
     )
+    # Price of the item when it was added to the cart.
+    price = Column(FLOAT(precision=64, decimal_return_scale=None), nullable=False, default=0.0)
 
     def to_dict(self):
        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
@@ -111,6 +135,135 @@ class Stock(Base):
     item_id = Column(UUID(as_uuid=True), primary_key=True)
     stock = Column(Integer, nullable=False, default=0)
     price = Column(FLOAT(precision=64, decimal_return_scale=None), nullable=False)
+    # Number of stock_shards rows the stock of a hot item is split over, 0 in single-row mode.
+    shards = Column(Integer, nullable=False, default=0)
+
+    def to_dict(self):
+       return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+class StockShard(Base):
+    """The StockShard class corresponds to the "stock_shards" database table.
+    Sub-counter of the stock of a hot item, so concurrent decrements do not all serialize on one row.
+    """
+    __tablename__ = 'stock_shards'
+
+    item_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey('stocks.item_id', ondelete="CASCADE"),
+        primary_key=True
+    )
+    shard = Column(Integer, primary_key=True)
+    stock = Column(Integer, nullable=False, default=0)
+    # Last write to the shard, shared by all workers to decide when the item went quiet.
+    updated_at = Column(DateTime, nullable=False, server_default=func.now(), onupdate=func.now())
+
+    def to_dict(self):
+       return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+class PaymentReservation(Base):
+    """The PaymentReservation class corresponds to the "payment_reservations" database table.
+    Holds the credit that a prepared 2PC transaction took from a user until it is committed or rolled back.
+    """
+    __tablename__ = 'payment_reservations'
+
+    transaction_id = Column(String, primary_key=True)
+    user_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey('users.user_id', ondelete="CASCADE"),
+        nullable=False
+    )
+    order_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey('orders.order_id', ondelete="CASCADE"),
+        nullable=False
+    )
+    amount = Column(FLOAT(precision=64, decimal_return_scale=None), nullable=False)
+    status = Column(String, nullable=False, default='prepared')
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+    expires_at = Column(DateTime, nullable=False)
+
+    def to_dict(self):
+       return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+class StockReservation(Base):
+    """The StockReservation class corresponds to the "stock_reservations" database table.
+    Holds the stock that a prepared 2PC transaction took from an item until it is committed or rolled back.
+    """
+    __tablename__ = 'stock_reservations'
+
+    transaction_id = Column(String, primary_key=True)
+    item_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey('stocks.item_id', ondelete="CASCADE"),
+        primary_key=True
+    )
+    amount = Column(Integer, nullable=False)
+    status = Column(String, nullable=False, default='prepared')
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+    expires_at = Column(DateTime, nullable=False)
+
+    def to_dict(self):
+       return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+class CheckoutLog(Base):
+    """The CheckoutLog class corresponds to the "checkout_log" database table.
+    Coordinator log of the order service, records the phase each checkout transaction is in.
+    """
+    __tablename__ = 'checkout_log'
+
+    transaction_id = Column(String, primary_key=True)
+    order_id = Column(UUID(as_uuid=True), nullable=False)
+    mode = Column(String, nullable=False, default='2pc')
+    phase = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+    updated_at = Column(DateTime, nullable=False, server_default=func.now(), onupdate=func.now())
+
+    def to_dict(self):
+       return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+class SagaCompensation(Base):
+    """The SagaCompensation class corresponds to the "saga_compensations" database table.
+    Compensating request of a saga step, armed before the step is sent and executed when the saga fails.
+    """
+    __tablename__ = 'saga_compensations'
+
+    transaction_id = Column(String, primary_key=True)
+    service = Column(String, primary_key=True)
+    path = Column(String, primary_key=True)
+    step_path = Column(String, nullable=False)
+    status = Column(String, nullable=False, default='armed')
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+    updated_at = Column(DateTime, nullable=False, server_default=func.now(), onupdate=func.now())
+
+    def to_dict(self):
+       return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+class PriceVersion(Base):
+    """The PriceVersion class corresponds to the "price_versions" database table.
+    Version of the item prices, bumped on every price change so that caches of the prices can be invalidated.
+    """
+    __tablename__ = 'price_versions'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+    def to_dict(self):
+       return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+class IdempotencyKey(Base):
+    """The IdempotencyKey class corresponds to the "idempotency_keys" database table.
+    Stored response of a request sent with an Idempotency-Key, replayed to retries of that request.
+    """
+    __tablename__ = 'idempotency_keys'
+
+    idempotency_key = Column(String, primary_key=True)
+    path = Column(String, nullable=False)
+    status = Column(String, nullable=False, default='in_progress')
+    response_status = Column(Integer)
+    response_body = Column(String)
+    response_mimetype = Column(String)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+    expires_at = Column(DateTime, nullable=False)
 
     def to_dict(self):
        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
@@ -1,33 +1,68 @@
+import json
 import os
 import sys
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import threading
+import time
+import traceback
+from sqlalchemy import select, bindparam, func, literal
 from sqlalchemy_cockroachdb import run_transaction
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from werkzeug.exceptions import HTTPException
 import uuid
-import json
+from datetime import datetime, timedelta
 
-import requests
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request
 
 # NOTE: make sure to run this app.py from this folder, so python app.py so that models are also read correctly from root
 sys.path.append("../")
-from orm_models.models import Order, Payment, User
+from orm_models.models import CreditEntry, Order, Payment, PaymentReservation, User
+from common.db import get_engine, get_sessionmaker, pool_stats
+from common.reaper import TransactionReaper, presume_abort_helper
+from common.idempotency import idempotent
 
 stock_url = os.environ['STOCK_URL']
 order_url = os.environ['ORDER_URL']
-datebase_url = os.environ['DATABASE_URL']
 
-app = Flask("payment-service")
+# Seconds a prepared transaction may wait for its commit or rollback before it gets rolled back.
+PREPARED_TX_TTL = float(os.environ.get('PREPARED_TX_TTL', 30))
+REAPER_INTERVAL = float(os.environ.get('REAPER_INTERVAL', 5))
+
+# Credit is changed in place on the user row ('row') or appended to the credit ledger ('ledger'),
+# whose entries are folded into the user rows every LEDGER_COMPACT_INTERVAL seconds.
+CREDIT_MODE = os.environ.get('CREDIT_MODE', 'row')
+LEDGER_COMPACT_INTERVAL = float(os.environ.get('LEDGER_COMPACT_INTERVAL', 5))
 
+# Rows per transaction of the batch endpoints.
+BATCH_CHUNK_SIZE = int(os.environ.get('BATCH_CHUNK_SIZE', 1000))
+
+
+app = Flask("payment-service")
 
-# Create engine to connect to the database
-try:
-    engine = create_engine(datebase_url, connect_args={'connect_timeout': 5})
-except Exception as e:
-    print("Failed to connect to database.")
-    print(f"{e}")
+users = User.__table__
+payments = Payment.__table__
+credit_ledger = CreditEntry.__table__
+
+# Credit of a user is the snapshot in its row plus the entries of the ledger that are not compacted yet.
+ledger_delta = func.coalesce(
+    select(func.sum(credit_ledger.c.amount))
+    .where(credit_ledger.c.user_id == users.c.user_id)
+    .scalar_subquery(),
+    0
+)
+balance = (users.c.credit + ledger_delta).label('credit')
+
+# Pre-built Core statements for the hot endpoints. SQLAlchemy caches their compiled form
+# and executing them on a plain connection skips the ORM identity map and unit of work.
+create_user_stmt = users.insert()
+find_user_stmt = select(users.c.user_id, balance).where(users.c.user_id == bindparam('user_id'))
+status_stmt = select(payments.c.payment_id) \
+    .where(payments.c.user_id == bindparam('user_id'), payments.c.order_id == bindparam('order_id')) \
+    .limit(1)
+
+# Exposes connection pool usage of this process, to size pools against the database connection limits.
+@app.get('/db_pool_stats')
+def db_pool_stats():
+    return jsonify(pool_stats()), 200
 
 # Catch all unhandled exceptions
 @app.errorhandler(Exception)
@@ -44,85 +79,228 @@ class NotEnoughCreditException(Exception):
     def __str__(self) -> str:
          return "Not enough credits"
 
+class OrderAlreadyPaidException(Exception):
+    """Exception class for handling payments of orders that are paid already"""
+    def __str__(self) -> str:
+         return "Order is already paid"
+
+class PaymentInProgressException(Exception):
+    """Exception class for handling payments of orders that are being paid by another transaction"""
+    def __str__(self) -> str:
+         return "Payment of order is already in progress"
+
+class TransactionFinalizedException(Exception):
+    """Exception class for handling a commit or rollback of a transaction that was decided otherwise"""
+    def __init__(self, status):
+        self.status = status
+
+    def __str__(self) -> str:
+         return f"Transaction is already {self.status}"
+
+# Status a reservation ends up in for each decision of the coordinator.
+FINAL_STATUS = {'commit': 'committed', 'rollback': 'aborted'}
+
 
 
 
 @app.post('/create_user')
 def create_user():
     user_uuid = uuid.uuid4()
-    new_user = User(user_id=user_uuid)
-    run_transaction(sessionmaker(bind=engine), lambda s: s.add(new_user))
+    run_transaction(
+        get_engine(),
+        lambda conn: conn.execute(create_user_stmt, {"user_id": user_uuid, "credit": 0})
+    )
     return jsonify(user_id=user_uuid), 200
 
-def find_user_helper(session, user_id):
-    user = session.query(User).filter(User.user_id == user_id).one()
+def create_users_helper(conn, count, credit):
+    user_uuids = [uuid.uuid4() for _ in range(count)]
+    # Executed as multi-row inserts by the driver.
+    conn.execute(create_user_stmt, [{"user_id": user_uuid, "credit": credit} for user_uuid in user_uuids])
+    return [str(user_uuid) for user_uuid in user_uuids]
+
+# Creates many users with the same initial credit, e.g. to load a benchmark dataset.
+# Expects a JSON body of the form {"count": ..., "credit": ...}.
+# Users are created in chunks of BATCH_CHUNK_SIZE, each in its own transaction, and the ids
+# are streamed back as NDJSON once their chunk is committed. If a chunk fails the stream
+# ends early, the ids sent until then are valid.
+@app.post('/create_user_batch')
+def create_users():
+    body = request.get_json(force=True)
+    count, credit = body.get('count'), body.get('credit', 0)
+    if not isinstance(count, int) or count <= 0:
+        return "Count must be a positive integer", 400
+    if not isinstance(credit, (int, float)) or credit < 0:
+        return "Credit cannot be negative", 400
+
+    def generate():
+        for start in range(0, count, BATCH_CHUNK_SIZE):
+            user_ids = run_transaction(
+                get_engine(),
+                lambda conn: create_users_helper(conn, min(BATCH_CHUNK_SIZE, count - start), float(credit))
+            )
+            yield ''.join(json.dumps({"user_id": user_id}) + '\n' for user_id in user_ids)
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+def find_user_helper(conn, user_id):
+    user = conn.execute(find_user_stmt, {"user_id": user_id}).one()
     return user
 
-#Blocking on same user
+# Serves the last committed credit, also while a payment of the user is in flight.
 @app.get('/find_user/<user_id>')
 def find_user(user_id: str):
-
-    if not isUserResourceAvailable(user_id):
-        return "User resource is not available", 400
-
     try:
-        # expire_on_commit=False to reuse returned User object attrs
         ret_user = run_transaction(
-            sessionmaker(bind=engine, expire_on_commit=False),
-            lambda s: find_user_helper(s, user_id)
+            get_engine(),
+            lambda conn: find_user_helper(conn, user_id)
         )
 
-        return jsonify(ret_user.to_dict()), 200
+        return jsonify(user_id=ret_user.user_id, credit=ret_user.credit), 200
     except NoResultFound:
         return "No user was found", 400
     except MultipleResultsFound:
         return "Multiple users were found while one is expected", 400
 
+# Credit is changed with single conditional statements instead of a read-modify-write
+# of the user row, which halves the round trips and avoids most serialization retries.
+# In ledger mode the statements append an entry instead of overwriting the user row,
+# the overdraft check still covers the snapshot and all entries, so it stays exact.
 def add_credit_helper(session, user_id, amount):
-    user = session.query(User).filter(User.user_id == user_id).one()
-    temp = float(user.credit)
-    temp += amount
-    user.credit = temp
+    if CREDIT_MODE == 'ledger':
+        updated = session.execute(
+            credit_ledger.insert()
+            .from_select(['user_id', 'amount'], select(users.c.user_id, literal(amount)).where(users.c.user_id == user_id))
+            .returning(credit_ledger.c.entry_id)
+        ).first()
+    else:
+        updated = session.execute(
+            users.update()
+            .where(users.c.user_id == user_id)
+            .values(credit=users.c.credit + amount)
+            .returning(users.c.credit)
+        ).first()
+    if updated is None:
+        raise NoResultFound("No row was found when one was required")
+
+def remove_credit_helper(session, user_id, amount):
+    if CREDIT_MODE == 'ledger':
+        updated = session.execute(
+            credit_ledger.insert()
+            .from_select(
+                ['user_id', 'amount'],
+                select(users.c.user_id, literal(-amount))
+                .where(users.c.user_id == user_id, users.c.credit + ledger_delta >= amount)
+            )
+            .returning(credit_ledger.c.entry_id)
+        ).first()
+    else:
+        # Only the row counts here, entries left by an earlier ledger mode are folded in by the compaction.
+        updated = session.execute(
+            users.update()
+            .where(users.c.user_id == user_id, users.c.credit >= amount)
+            .values(credit=users.c.credit - amount)
+            .returning(users.c.credit)
+        ).first()
+    if updated is None:
+        # Nothing was updated, find out whether the user is missing or short on credit.
+        session.query(User.user_id).filter(User.user_id == user_id).one()
+        raise NotEnoughCreditException()
+
+def compact_ledger_helper(session, user_id):
+    """Folds the ledger entries of a user into its credit snapshot, returns how many there were."""
+    entries = session.execute(
+        credit_ledger.delete()
+        .where(credit_ledger.c.user_id == user_id)
+        .returning(credit_ledger.c.amount)
+    ).all()
+    if entries:
+        session.execute(
+            users.update()
+            .where(users.c.user_id == user_id)
+            .values(credit=users.c.credit + sum(entry.amount for entry in entries))
+        )
+    return len(entries)
+
+def ledger_users_helper(session):
+    rows = session.execute(select(credit_ledger.c.user_id).distinct().limit(100)).all()
+    return [row.user_id for row in rows]
+
+ledger_counters = {"runs": 0, "users": 0, "entries": 0}
+ledger_lock = threading.Lock()
+
+def compact_ledger():
+    """Background compaction, every user gets its own short transaction."""
+    while True:
+        time.sleep(LEDGER_COMPACT_INTERVAL)
+        try:
+            compacted = 0
+            user_ids = run_transaction(get_sessionmaker(), ledger_users_helper)
+            for user_id in user_ids:
+                compacted += run_transaction(get_sessionmaker(), lambda s: compact_ledger_helper(s, user_id))
+            with ledger_lock:
+                ledger_counters["runs"] += 1
+                ledger_counters["users"] += len(user_ids)
+                ledger_counters["entries"] += compacted
+        except Exception:
+            traceback.print_exc()
+
+# Also runs in row mode, to drain the entries of a deployment that switched back from the ledger.
+threading.Thread(target=compact_ledger, name="ledger-compaction", daemon=True).start()
+
+# Exposes how many ledger entries were folded into the user rows by this process.
+@app.get('/ledger_stats')
+def ledger_stats():
+    with ledger_lock:
+        return jsonify(ledger_counters), 200
 
 @app.post('/add_funds/<user_id>/<amount>')
 def add_credit(user_id: str, amount: float):
-
-    if not isUserResourceAvailable(user_id):
-        return "User resource is not available", 400
-
     try:
         run_transaction(
-            sessionmaker(bind=engine),
+            get_sessionmaker(),
             lambda s: add_credit_helper(s, user_id, float(amount))
         )
         return jsonify(done=True), 200
     except Exception as e:
         return str(e), 400
 
+# The order can only be paid by one transaction at a time. Checked against the reservations in
+# the database, so it holds across workers and replicas, credit needs no check: the debit is conditional.
+def payment_in_progress_helper(session, order_id):
+    pending = session.query(PaymentReservation.transaction_id).filter(
+        PaymentReservation.order_id == order_id,
+        PaymentReservation.status == 'prepared'
+    ).first()
+    if pending:
+        raise PaymentInProgressException()
+
 def pay_helper(session, user_id, order_id, amount):
-    user = session.query(User).filter(User.user_id == user_id).one()
-
-    status = json.loads(payment_status(user_id, order_id).get_data(as_text=True))
-    if not status['paid']:
-        if user.credit >= float(amount):
-            user.credit -= float(amount)
-            new_payment = Payment(user_id=user_id, order_id=order_id, amount=amount)
-            session.add(new_payment)
-        else:
-            raise NotEnoughCreditException()
-        
+    payment_in_progress_helper(session, order_id)
+    # Read in the caller's transaction, so the check and the debit see the same state.
+    # An order that was paid before is refused rather than acknowledged, otherwise a caller
+    # that undoes its payment, e.g. a failed saga, would refund a payment it never made.
+    if status_helper(session, user_id, order_id):
+        raise OrderAlreadyPaidException()
+    remove_credit_helper(session, user_id, float(amount))
+    new_payment = Payment(user_id=user_id, order_id=order_id, amount=amount)
+    session.add(new_payment)
 
     
 @app.post('/pay/<user_id>/<order_id>/<amount>')
+@idempotent('payment')
 def remove_credit(user_id: str, order_id: str, amount: float):
     print("Remove credit started")
     try:
         run_transaction(
-            sessionmaker(bind=engine),
+            get_sessionmaker(),
             lambda s: pay_helper(s, user_id, order_id, float(amount))
         )
         print("Remove credit ended")
         return '', 200
+    except PaymentInProgressException as e:
+        return str(e), 409
+    except OrderAlreadyPaidException as e:
+        return str(e), 400
     except NoResultFound:
         return "No user or order was found", 401
     except MultipleResultsFound:
@@ -130,66 +308,54 @@ def remove_credit(user_id: str, order_id: str, amount: float):
     except NotEnoughCreditException as e:
         return str(e), 403
     except Exception as e:
-        return str(e), 404
+        # Transient, e.g. the database is unreachable, so a retry must run it again.
+        return str(e), 503
 
 def cancel_payment_helper(session, user_id, order_id):
-    user = session.query(User).filter(User.user_id == user_id).one()
-    status = json.loads(payment_status(user_id, order_id).get_data(as_text=True))
+    payment_in_progress_helper(session, order_id)
     payment = session.query(Payment).filter(
         Payment.user_id == user_id,
         Payment.order_id == order_id
-    ).one()
-
-    # Only add amount of payment to the user if the order is paid already
-    if status['paid']:
-        temp = float(user.credit)
-        temp += payment.amount
-        user.credit = temp
+    ).first()
 
-    print(session.query(Payment).filter(
-        Payment.user_id == user_id,
-        Payment.order_id == order_id
-    ).delete())
-    
+    # Nothing to undo, e.g. a compensation of a payment that never went through.
+    if payment is None:
+        return
+    add_credit_helper(session, user_id, payment.amount)
+    session.delete(payment)
 
+# Safe to retry with an Idempotency-Key: a retry is answered from the stored response
+# and never refunds a payment that was made again in between.
 @app.post('/cancel/<user_id>/<order_id>')
+@idempotent('payment')
 def cancel_payment(user_id: str, order_id: str):
-
-    if not isResourceAvailable(user_id, order_id):
-        return "Resource is not available", 400
-
     try:
         run_transaction(
-            sessionmaker(bind=engine), 
+            get_sessionmaker(), 
             lambda s: cancel_payment_helper(s, user_id, order_id)
         )
         return '', 200
+    except PaymentInProgressException as e:
+        return str(e), 409
     except NoResultFound:
         return "No user or payment was found", 401
     except MultipleResultsFound:
         return "Multiple users or payments were found while one is expected", 402
     except Exception as e:
-        return str(e), 404
+        return str(e), 503
 
 
-def status_helper(session, user_id, order_id):
-    payment_paid = session \
-        .query(Payment) \
-        .filter(
-            Payment.user_id == user_id, # and
-            Payment.order_id == order_id
-        ).first()
-    return payment_paid
+# Works on both a session and a plain connection.
+def status_helper(conn, user_id, order_id) -> bool:
+    payment_paid = conn.execute(status_stmt, {"user_id": user_id, "order_id": order_id}).first()
+    return payment_paid is not None
 
+# Serves the last committed status, also while a payment of the order is in flight.
 @app.post('/status/<user_id>/<order_id>')
 def payment_status(user_id: str, order_id: str):
-
-    if not isResourceAvailable(user_id, order_id):
-        return "Resource is not available, payment in progress", 400
-
     ret_paid = run_transaction(
-        sessionmaker(bind=engine, expire_on_commit=False), 
-        lambda s: status_helper(s, user_id, order_id)
+        get_engine(),
+        lambda conn: status_helper(conn, user_id, order_id)
     )
     if ret_paid:
         return jsonify(paid=True)
@@ -197,22 +363,36 @@ def payment_status(user_id: str, order_id: str):
         return jsonify(paid=False)
 
 
-transactions = {}
-
+def prepare_pay_helper(session, transaction_id, user_id, order_id, amount):
+    reservation = session.query(PaymentReservation).filter(
+        PaymentReservation.transaction_id == transaction_id
+    ).first()
+    if reservation:
+        # Prepare was already done, e.g. a retried request.
+        return
+
+    if status_helper(session, user_id, order_id):
+        raise OrderAlreadyPaidException()
+    payment_in_progress_helper(session, order_id)
+
+    remove_credit_helper(session, user_id, amount)
+    session.add(PaymentReservation(
+        transaction_id=transaction_id,
+        user_id=user_id,
+        order_id=order_id,
+        amount=amount,
+        expires_at=datetime.utcnow() + timedelta(seconds=PREPARED_TX_TTL)
+    ))
+
+# Reserves the credit of the user in a short transaction that is committed immediately,
+# so no session or row lock is held until the coordinator decides.
 @app.post('/prepare_pay/<transaction_id>/<user_id>/<order_id>/<amount>')
 def prepare_remove_credit(transaction_id, user_id: str, order_id: str, amount: float):
     try:
-        session = sessionmaker(engine)()
-        pay_helper(session, user_id, order_id, amount)
-
-        transactions[transaction_id] = {
-                                        "session": session,
-                                        "user_id": user_id,
-                                        "order_id": order_id,
-                                        }
-
-
-        session.flush()
+        run_transaction(
+            get_sessionmaker(),
+            lambda s: prepare_pay_helper(s, transaction_id, user_id, order_id, float(amount))
+        )
         return 'Ready', 200
     except NoResultFound:
         return "No user or order was found", 401
@@ -223,36 +403,70 @@ def prepare_remove_credit(transaction_id, user_id: str, order_id: str, amount: f
     except Exception as e:
         return str(e), 404
 
+def end_transaction_helper(session, transaction_id, status):
+    reservation = session.query(PaymentReservation).filter(
+        PaymentReservation.transaction_id == transaction_id
+    ).first()
+    if reservation is None:
+        if status == 'rollback':
+            # Nothing was reserved, e.g. the participant voted no.
+            return
+        raise NoResultFound("No row was found when one was required")
+    if reservation.status != 'prepared':
+        if reservation.status != FINAL_STATUS[status]:
+            raise TransactionFinalizedException(reservation.status)
+        # Already finalized, e.g. a retried request.
+        return
+
+    if status == 'commit':
+        session.add(Payment(
+            user_id=reservation.user_id,
+            order_id=reservation.order_id,
+            amount=reservation.amount
+        ))
+    else:
+        add_credit_helper(session, reservation.user_id, reservation.amount)
+    reservation.status = FINAL_STATUS[status]
+
+# Finalizes (commit) or releases (rollback) the reservation of a transaction.
+# Can be handled by any worker or replica, since the reservation is stored in the database.
 @app.post('/endTransaction/<transaction_id>/<status>')
 def endTransaction(transaction_id, status):
+    if status not in FINAL_STATUS:
+        return 'Unknown status: ' + status, 400
     try:
-        if status == 'commit':
-            transactions[transaction_id]["session"].commit()
-            transactions[transaction_id]["session"].close()
-        elif status == 'rollback':
-            transactions[transaction_id]["session"].rollback()
-            transactions[transaction_id]["session"].close()
-        else :
-            return 'Unknown status: ' + status, 400
-        del transactions[transaction_id]
+        run_transaction(
+            get_sessionmaker(),
+            lambda s: end_transaction_helper(s, transaction_id, status)
+        )
         return 'Success', 200
-
+    except TransactionFinalizedException as e:
+        # A final answer: the coordinator must not retry this decision.
+        return str(e), 409
     except Exception:
         return 'failure', 400
 
 
-def isUserResourceAvailable(user_id):
-    for key in transactions:
-        if transactions[key]["user_id"] == user_id:
-            return False
-    return True
-
-
-def isOrderResourceAvailable(order_id):
-    for key in transactions:
-        if transactions[key]["order_id"] == order_id:
-            return False
-    return True
+def find_expired_helper(session):
+    expired = session.query(PaymentReservation.transaction_id).filter(
+        PaymentReservation.status == 'prepared',
+        PaymentReservation.expires_at < datetime.utcnow()
+    ).limit(100).all()
+    return [row.transaction_id for row in expired]
+
+reaper = TransactionReaper(
+    lambda: run_transaction(get_sessionmaker(), find_expired_helper),
+    lambda transaction_id: run_transaction(
+        get_sessionmaker(),
+        lambda s: end_transaction_helper(s, transaction_id, 'rollback')
+    ),
+    REAPER_INTERVAL,
+    lambda transaction_id: run_transaction(get_sessionmaker(), lambda s: presume_abort_helper(s, transaction_id))
+)
+reaper.start()
+
+# Exposes how many expired prepared transactions were rolled back by this process.
+@app.get('/reaper_stats')
+def reaper_stats():
+    return jsonify(reaper.stats()), 200
 
-def isResourceAvailable(user_id, order_id):
-    return isUserResourceAvailable(user_id) and isOrderResourceAvailable(order_id)
@@ -0,0 +1,181 @@
+import functools
+import json
+import os
+from datetime import datetime, timedelta
+
+from flask import Response, current_app, request
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy_cockroachdb import run_transaction
+
+from orm_models.models import IdempotencyKey
+from common.db import get_sessionmaker
+
+# Seconds a stored response is replayed, and seconds after which a request that never
+# finished (e.g. its worker crashed) no longer blocks retries with the same key.
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', 24 * 3600))
+IDEMPOTENCY_LOCK_TTL = float(os.environ.get('IDEMPOTENCY_LOCK_TTL', 60))
+
+# Where keys and stored responses live: 'database' (the idempotency_keys table) or 'redis'.
+IDEMPOTENCY_STORE = os.environ.get('IDEMPOTENCY_STORE', 'database')
+
+HEADER = 'Idempotency-Key'
+
+IN_PROGRESS = 'in_progress'
+DONE = 'done'
+
+
+class KeyInUseException(Exception):
+    """Exception class for handling a key that a concurrent first request claimed first"""
+    def __str__(self) -> str:
+         return f"A request with this {HEADER} is in progress"
+
+
+def claim_key_helper(session, key, path):
+    """Claims the key for this request, or returns the stored row if another request holds it."""
+    now = datetime.utcnow()
+    row = session.query(IdempotencyKey).filter(IdempotencyKey.idempotency_key == key).first()
+    if row is not None and row.expires_at > now:
+        return row.to_dict()
+    if row is None:
+        row = IdempotencyKey(idempotency_key=key)
+        session.add(row)
+    row.path = path
+    row.status = IN_PROGRESS
+    row.response_status = row.response_body = row.response_mimetype = None
+    row.expires_at = now + timedelta(seconds=IDEMPOTENCY_LOCK_TTL)
+    return None
+
+def store_response_helper(session, key, response):
+    session.query(IdempotencyKey).filter(IdempotencyKey.idempotency_key == key).update({
+        IdempotencyKey.status: DONE,
+        IdempotencyKey.response_status: response.status_code,
+        IdempotencyKey.response_body: response.get_data(as_text=True),
+        IdempotencyKey.response_mimetype: response.mimetype,
+        IdempotencyKey.expires_at: datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_TTL)
+    }, synchronize_session=False)
+
+def release_key_helper(session, key):
+    session.query(IdempotencyKey).filter(IdempotencyKey.idempotency_key == key).delete(synchronize_session=False)
+
+
+class DatabaseKeyStore:
+    """Keys in the idempotency_keys table, next to the data the requests change."""
+
+    def claim(self, key, path):
+        """Claims the key, or returns what is stored for it as a dict."""
+        try:
+            return run_transaction(get_sessionmaker(), lambda s: claim_key_helper(s, key, path))
+        except IntegrityError:
+            # A concurrent first request with the same key inserted it first.
+            raise KeyInUseException()
+
+    def store(self, key, response):
+        run_transaction(get_sessionmaker(), lambda s: store_response_helper(s, key, response))
+
+    def release(self, key):
+        run_transaction(get_sessionmaker(), lambda s: release_key_helper(s, key))
+
+
+class RedisKeyStore:
+    """Keys in Redis, for services that keep their data there as well.
+
+    A key is claimed with SET NX, so of concurrent first requests exactly one wins,
+    and expires by itself after the lock or replay time to live.
+    """
+
+    KEY = 'idempotency:{}'
+
+    def __init__(self):
+        # Only needed for this backend, so services without Redis do not need the package.
+        import redis
+        self.db = redis.Redis(
+            host=os.environ.get('REDIS_HOST', 'localhost'),
+            port=int(os.environ.get('REDIS_PORT', 6379)),
+            password=os.environ.get('REDIS_PASSWORD'),
+            db=int(os.environ.get('REDIS_DB', 0))
+        )
+
+    def claim(self, key, path):
+        claim = json.dumps({"path": path, "status": IN_PROGRESS})
+        if self.db.set(self.KEY.format(key), claim, nx=True, px=int(IDEMPOTENCY_LOCK_TTL * 1000)):
+            return None
+        stored = self.db.get(self.KEY.format(key))
+        if stored is None:
+            # Expired in between, the next attempt gets the claim or sees the new holder.
+            raise KeyInUseException()
+        return json.loads(stored)
+
+    def store(self, key, response):
+        self.db.set(self.KEY.format(key), json.dumps({
+            "path": request.path,
+            "status": DONE,
+            "response_status": response.status_code,
+            "response_body": response.get_data(as_text=True),
+            "response_mimetype": response.mimetype
+        }), px=int(IDEMPOTENCY_TTL * 1000))
+
+    def release(self, key):
+        self.db.delete(self.KEY.format(key))
+
+
+key_stores = {'database': DatabaseKeyStore, 'redis': RedisKeyStore}
+key_store = None
+
+def get_key_store():
+    """Returns the key store of this process, created on first use."""
+    global key_store
+    if key_store is None:
+        key_store = key_stores[IDEMPOTENCY_STORE]()
+    return key_store
+
+
+def idempotent(scope, derive_key=None):
+    """Makes a route replay its stored response to requests with an already used Idempotency-Key.
+
+    Keys are namespaced by `scope`. Without the header, `derive_key(**view_args)` can supply
+    a key; responses to derived keys are only stored when they succeeded, so a request that
+    failed, e.g. for lack of stock, can still be retried for real. A duplicate of a request
+    that is still running gets a 409.
+
+    Only final outcomes are stored. Routes answer transient failures, e.g. an unreachable
+    upstream service or a database error, with a 5xx and conflicts with work still in
+    progress with a 409, neither of which is stored, so a retry runs the request for real.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            key = request.headers.get(HEADER)
+            store_failures = key is not None
+            if key is None and derive_key is not None:
+                key = derive_key(**kwargs)
+            if key is None:
+                return view(**kwargs)
+
+            key = f"{scope}:{key}"
+            try:
+                stored = get_key_store().claim(key, request.path)
+            except KeyInUseException as e:
+                return str(e), 409
+            if stored is not None:
+                if stored['path'] != request.path:
+                    return f"{HEADER} was already used for another request", 422
+                if stored['status'] == IN_PROGRESS:
+                    return f"A request with this {HEADER} is in progress", 409
+                return Response(
+                    stored['response_body'],
+                    status=stored['response_status'],
+                    mimetype=stored['response_mimetype']
+                )
+
+            try:
+                response = current_app.make_response(view(**kwargs))
+            except Exception:
+                get_key_store().release(key)
+                raise
+            if response.status_code < (500 if store_failures else 400) and response.status_code != 409:
+                get_key_store().store(key, response)
+            else:
+                get_key_store().release(key)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,84 @@
+import threading
+import time
+import traceback
+
+from orm_models.models import CheckoutLog
+
+# Phases of the coordinator log (checkout_log of the order service) that the reaper reads and writes.
+PREPARING = 'preparing'
+ABORTING = 'aborting'
+COMMIT_PHASES = ['committing', 'committed']
+
+
+# A participant that voted yes must not abort on its own once the coordinator decided to commit.
+# The reaper therefore takes the rollback decision in the coordinator log itself, in the place of
+# a coordinator that never decided, and leaves transactions that were decided to commit alone:
+# the coordinator or its recovery still sends that commit. The order service only decides to
+# commit a checkout that is still preparing, so the two decisions can never both be taken.
+def presume_abort_helper(session, transaction_id):
+    """Returns whether the prepared transaction may be rolled back."""
+    log = session.query(CheckoutLog).filter(CheckoutLog.transaction_id == transaction_id).first()
+    if log is None:
+        # Not a checkout of the order service, e.g. a prepare sent by hand.
+        return True
+    if log.phase in COMMIT_PHASES:
+        return False
+    if log.phase == PREPARING:
+        log.phase = ABORTING
+    return True
+
+
+class TransactionReaper:
+    """Background thread that rolls back prepared transactions past their deadline.
+
+    A coordinator that crashes or times out between prepare and endTransaction would
+    otherwise leave its reservation behind forever. Every `interval` seconds the reaper
+    asks `find_expired` for the ids of expired prepared transactions and rolls each of
+    them back with `rollback`, unless `may_rollback` refuses because the transaction was
+    decided to commit. Reservations live in the storage, so any worker's reaper can
+    release those of every other worker.
+    """
+
+    def __init__(self, find_expired, rollback, interval, may_rollback):
+        self.find_expired = find_expired
+        self.rollback = rollback
+        self.interval = interval
+        self.may_rollback = may_rollback
+        self.counters = {"runs": 0, "reaped": 0, "skipped": 0, "failed": 0}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="transaction-reaper", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception:
+                traceback.print_exc()
+
+    def run_once(self):
+        reaped = skipped = failed = 0
+        for transaction_id in self.find_expired():
+            try:
+                if not self.may_rollback(transaction_id):
+                    skipped += 1
+                    continue
+                self.rollback(transaction_id)
+                reaped += 1
+            except Exception:
+                failed += 1
+
+        with self.lock:
+            self.counters["runs"] += 1
+            self.counters["reaped"] += reaped
+            self.counters["skipped"] += skipped
+            self.counters["failed"] += failed
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
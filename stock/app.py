@@ -1,29 +1,49 @@
+import csv
+import itertools
+import json
 import os
 import sys
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy_cockroachdb import run_transaction
-from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 import uuid
 from werkzeug.exceptions import HTTPException
 
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request, stream_with_context
+from sqlalchemy_cockroachdb import run_transaction
 
 # NOTE: make sure to run this app.py from this folder, so python app.py so that models are also read correctly from root
 sys.path.append("../")
-from orm_models.models import Stock
+from common.db import get_sessionmaker, pool_stats
+from common.reaper import TransactionReaper, presume_abort_helper
+from common.idempotency import idempotent
+from storage.base import ItemNotFoundException, NotEnoughStockException, TransactionFinalizedException, FINAL_STATUS
+
+# Seconds a prepared transaction may wait for its commit or rollback before it gets rolled back.
+PREPARED_TX_TTL = float(os.environ.get('PREPARED_TX_TTL', 30))
+REAPER_INTERVAL = float(os.environ.get('REAPER_INTERVAL', 5))
 
-datebase_url = os.environ['DATABASE_URL']
+# Rows per transaction of the batch endpoints.
+BATCH_CHUNK_SIZE = int(os.environ.get('BATCH_CHUNK_SIZE', 1000))
+
+# Storage engine of the stock: 'cockroachdb' (durable) or 'redis' (in memory, see env/stock_redis.env).
+STOCK_STORAGE = os.environ.get('STOCK_STORAGE', 'cockroachdb')
 
 app = Flask("stock-service")
 
+if STOCK_STORAGE == 'redis':
+    from storage.redis_store import RedisStockStore
+    store = RedisStockStore()
+else:
+    from storage.cockroach import CockroachStockStore
+    store = CockroachStockStore()
+store.start()
+
 # DATABASE_URL= "cockroachdb://root@localhost:26257/defaultdb?sslmode=disable"
 
-try:
-    engine = create_engine(datebase_url, connect_args={'connect_timeout': 5})
-except Exception as e:
-    print("Failed to connect to database.")
-    print(f"{e}")
+# Exposes connection pool usage of this process, to size pools against the database connection limits.
+@app.get('/db_pool_stats')
+def db_pool_stats():
+    if 'DATABASE_URL' not in os.environ:
+        return "This service does not use a database", 404
+    return jsonify(pool_stats()), 200
 
 # Catch all unhandled exceptions
 @app.errorhandler(Exception)
@@ -31,139 +51,282 @@ def handle_exception(e):
     # pass through HTTP errors
     if isinstance(e, HTTPException):
         return jsonify(error=str(e)), 400
-    
+
     # now you're handling non-HTTP exceptions only
     return jsonify(error=str(e)), 400
 
-class NotEnoughStockException(Exception):
-    """Exception class for handling insufficient stock of an item"""
-    def __str__(self) -> str:
-         return "Stock cannot be negative"
-
 
 
 
 @app.post('/item/create/<price>')
 def create_item(price: float):
-    item_uuid = uuid.uuid4()
-    new_item = Stock(item_id=item_uuid, price=float(price))
-    run_transaction(sessionmaker(bind=engine), lambda s: s.add(new_item))
-    return jsonify(item_id=item_uuid)
+    item_id = store.create_item(float(price))
+    return jsonify(item_id=item_id)
 
-def find_item_helper(session, item_id):
-    item = session.query(Stock).filter(Stock.item_id == item_id).one()
-    return item
+# Creates many items with the same price and initial stock, e.g. to load a benchmark dataset.
+# Expects a JSON body of the form {"count": ..., "price": ..., "stock": ...}.
+# Items are created in chunks of BATCH_CHUNK_SIZE, each in its own transaction, and the ids
+# are streamed back as NDJSON once their chunk is committed. If a chunk fails the stream
+# ends early, the ids sent until then are valid.
+@app.post('/item/create_batch')
+def create_items():
+    body = request.get_json(force=True)
+    count, price, stock = body.get('count'), body.get('price', 0), body.get('stock', 0)
+    if not isinstance(count, int) or count <= 0:
+        return "Count must be a positive integer", 400
+    if not isinstance(price, (int, float)) or price < 0:
+        return "Price cannot be negative", 400
+    if not isinstance(stock, int) or stock < 0:
+        return "Stock cannot be negative", 400
 
+    def generate():
+        for start in range(0, count, BATCH_CHUNK_SIZE):
+            item_ids = store.create_items(min(BATCH_CHUNK_SIZE, count - start), price, stock)
+            yield ''.join(json.dumps({"item_id": item_id}) + '\n' for item_id in item_ids)
 
-@app.get('/find/<item_id>')
-def find_item(item_id: str):
+    return Response(generate(), mimetype='application/x-ndjson')
 
-    if not isItemResourceAvailable(item_id):
-        return "Item is being used by another transaction", 400
 
+# Serves the last committed stock, also while a checkout of the item is in flight.
+@app.get('/find/<item_id>')
+def find_item(item_id: str):
     try:
-        ret_item = run_transaction(
-            sessionmaker(bind=engine, expire_on_commit=False),
-            lambda s: find_item_helper(s, item_id)
-        )
+        ret_item = store.find_item(item_id)
         return jsonify(
-            stock=ret_item.stock,
-            price=ret_item.price
+            stock=ret_item['stock'],
+            price=ret_item['price']
         )
-    except NoResultFound:
-        return "No item was found", 400
-    except MultipleResultsFound:
-        return "Multiple items were found while one is expected", 400
+    except ItemNotFoundException as e:
+        return str(e), 400
+
+# Batch lookup of stock and price, so callers need one round trip for a whole cart.
+# Expects a JSON body of the form {"item_ids": [...]}.
+# The prices are returned with the price version they were read under.
+@app.post('/find_batch')
+def find_items():
+    item_ids = list(set(request.get_json(force=True).get('item_ids', [])))
+    try:
+        ret_items, version = store.find_items(item_ids)
+        return jsonify(version=version, items=ret_items)
+    except ItemNotFoundException as e:
+        return str(e), 400
 
-def add_stock_helper(session, item_id, amount):
-    item = session.query(Stock).filter(Stock.item_id == item_id).one()
-    item.stock += amount
+# Current price version, polled by the price caches of the other services.
+@app.get('/price_version')
+def price_version():
+    return jsonify(version=store.price_version())
 
+@app.post('/item/price/<item_id>/<price>')
+def set_price(item_id: str, price: float):
+    try:
+        store.set_price(item_id, float(price))
+        return "Success", 200
+    except ItemNotFoundException as e:
+        return str(e), 400
+
+# Safe to retry with an Idempotency-Key, e.g. when it compensates a subtraction.
 @app.post('/add/<item_id>/<int:amount>')
+@idempotent('stock')
 def add_stock(item_id: str, amount: int):
+    try:
+        store.add_stock(item_id, amount)
+        return '', 200
+    except ItemNotFoundException as e:
+        return str(e), 400
+
+def parse_restock_rows(lines, fmt):
+    """Yields (line number, (item_id, delta, price or None), error) for every row of an
+    NDJSON ({"item_id": ..., "delta": ..., "price": ...}) or CSV (item_id,delta[,price]) body
+    given as lines of UTF-8 encoded bytes. Lines that are not valid UTF-8 are rejected rows.
+    A CSV header is skipped when it is the first non-empty row. Reads one line at a time,
+    so the body is never held in memory.
+    """
+    first = True
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        is_first, first = first, False
+        try:
+            line = line.decode('utf-8')
+        except UnicodeDecodeError:
+            yield number, None, "Invalid row: not UTF-8 encoded"
+            continue
+        try:
+            if fmt == 'csv':
+                row = next(csv.reader([line]))
+                if is_first and row[0].strip().lstrip('\ufeff').lower() == 'item_id':
+                    continue
+                item_id, delta, price = (row + [''])[:3]
+            else:
+                fields = json.loads(line)
+                item_id, delta, price = fields['item_id'], fields['delta'], fields.get('price')
+            item_id = str(uuid.UUID(item_id.strip()))
+            if isinstance(delta, str):
+                delta = int(delta)
+            if not isinstance(delta, int) or isinstance(delta, bool):
+                raise ValueError("Delta must be an integer")
+            price = None if price is None or price == '' else float(price)
+            if price is not None and price < 0:
+                raise ValueError("Price cannot be negative")
+        except KeyError as e:
+            yield number, None, f"Invalid row: missing {str(e)}"
+            continue
+        except (ValueError, IndexError, TypeError, AttributeError) as e:
+            yield number, None, f"Invalid row: {str(e)}"
+            continue
+        yield number, (item_id, delta, price), None
 
-    if not isItemResourceAvailable(item_id):
-        return "Item is being used by another transaction", 400
+def apply_restock_batch(rows):
+    """Applies the parsed rows of one batch. Every item appears at most once per storage call,
+    so rows repeating an item are applied in a following call, in the order of the body.
+    Returns the number of applied rows and the rejected rows.
+    """
+    rounds = []
+    rejected = []
+    for number, row, error in rows:
+        if error is not None:
+            rejected.append({"line": number, "error": error})
+            continue
+        item_id, delta, price = row
+        for items, lines in rounds:
+            if item_id not in items:
+                break
+        else:
+            items, lines = {}, {}
+            rounds.append((items, lines))
+        items[item_id] = (delta, price)
+        lines[item_id] = number
 
+    applied = 0
+    for items, lines in rounds:
+        skipped = store.restock(items)
+        rejected.extend({"line": lines[item_id], "error": reason} for item_id, reason in skipped.items())
+        applied += len(items) - len(skipped)
+    rejected.sort(key=lambda rejection: rejection["line"])
+    return applied, rejected
+
+# Bulk restock from a streamed NDJSON (default) or CSV (text/csv or ?format=csv) body of
+# (item_id, delta[, price]) rows, e.g. an export of the ERP. Rows are applied in batches of
+# BATCH_CHUNK_SIZE, each with a single statement in its own transaction. Progress is streamed
+# back as NDJSON: one line per committed batch with its rejected rows, then a summary line.
+@app.post('/restock')
+def restock():
+    fmt = request.args.get('format', 'csv' if request.mimetype == 'text/csv' else 'ndjson')
+    if fmt not in ('csv', 'ndjson'):
+        return 'Unknown format: ' + fmt, 400
+
+    def generate():
+        batches = applied = rejected = 0
+        rows = parse_restock_rows(request.stream, fmt)
+        while True:
+            batch = list(itertools.islice(rows, BATCH_CHUNK_SIZE))
+            if not batch:
+                break
+            batches += 1
+            try:
+                batch_applied, batch_rejected = apply_restock_batch(batch)
+            except Exception as e:
+                # Earlier batches stay committed, report where the import stopped.
+                yield json.dumps({"batch": batches, "error": str(e)}) + '\n'
+                return
+            applied += batch_applied
+            rejected += len(batch_rejected)
+            yield json.dumps({"batch": batches, "applied": batch_applied, "rejected": batch_rejected}) + '\n'
+        yield json.dumps({"done": True, "batches": batches, "applied": applied, "rejected": rejected}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# Switches an item between single-row mode (0 shards) and sharded mode by hand.
+@app.post('/item/shards/<item_id>/<int:shards>')
+def set_item_shards(item_id: str, shards: int):
     try:
-        run_transaction(
-            sessionmaker(bind=engine),
-            lambda s: add_stock_helper(s, item_id, amount)
-        )
-        return '', 200
-    except NoResultFound:
-        return "No item was found", 400
-    except MultipleResultsFound:
-        return "Multiple items were found while one is expected", 400
-
-def remove_stock_helper(session, item_id, amount):
-    item = session.query(Stock).filter(Stock.item_id == item_id).one()
-    if item.stock >= amount:
-        item.stock -= amount
-    else:
-        raise NotEnoughStockException()
+        store.set_shards(item_id, shards)
+        return 'Success', 200
+    except ItemNotFoundException as e:
+        return str(e), 400
+    except NotImplementedError as e:
+        return str(e), 501
+
+# Exposes the contention observed by this process and how many items it (un)sharded.
+@app.get('/shard_stats')
+def shard_stats():
+    return jsonify(store.stats()), 200
 
 @app.post('/subtract/<item_id>/<int:amount>')
+@idempotent('stock')
 def remove_stock(item_id: str, amount: int):
     print("Remove stock started")
     try:
-        run_transaction(
-            sessionmaker(bind=engine),
-            lambda s: remove_stock_helper(s, item_id, amount)
-        )
+        store.remove_stock(item_id, amount)
         print("Remove stock ended")
         return '', 200
-    except NoResultFound:
-        return "No item was found", 400
-    except MultipleResultsFound:
-        return "Multiple items were found while one is expected", 400
+    except ItemNotFoundException as e:
+        return str(e), 400
     except NotEnoughStockException as e:
         return str(e), 400
 
-transactions = {}
-
+# Reserves the stock of the item in a short transaction that is committed immediately,
+# so no session or row lock is held until the coordinator decides.
 @app.post('/prepare_subtract/<transaction_id>/<item_id>/<int:amount>')
 def prepare_remove_stock(transaction_id, item_id: str, amount: int):
+    # Reservations are taken with a conditional decrement, so concurrent transactions
+    # and direct writes can share the item without any lock held in between.
     try:
-        session = None
-        if transaction_id in transactions:
-            session = transactions[transaction_id]["session"]
-        else :
-            session = sessionmaker(engine)()
-            transactions[transaction_id] = {
-                                            "session": session,
-                                            "item_id": item_id
-                                            }
-
-        remove_stock_helper(session, item_id, amount)
-        session.flush()
+        store.prepare_remove_stock(transaction_id, item_id, amount, PREPARED_TX_TTL)
+        return 'Ready', 200
+    except ItemNotFoundException as e:
+        return str(e), 400
+    except NotEnoughStockException as e:
+        return str(e), 400
+
+# Reserves the stock of a whole cart in one transaction.
+# Expects a JSON body of the form {"items": {item_id: amount, ...}}.
+@app.post('/prepare_subtract_batch/<transaction_id>')
+def prepare_remove_stock_batch(transaction_id):
+    items = {str(item_id): int(amount) for item_id, amount in request.get_json(force=True).get('items', {}).items()}
+    if not items or any(amount <= 0 for amount in items.values()):
+        return "Amounts must be positive", 400
 
+    try:
+        store.prepare_remove_stock_batch(transaction_id, items, PREPARED_TX_TTL)
         return 'Ready', 200
-    except NoResultFound:
-        return "No item was found", 400
-    except MultipleResultsFound:
-        return "Multiple items were found while one is expected", 400
+    except ItemNotFoundException as e:
+        return str(e), 400
     except NotEnoughStockException as e:
         return str(e), 400
 
+# Finalizes (commit) or releases (rollback) the reservations of a transaction.
+# Can be handled by any worker or replica, since the reservations are stored in the storage engine.
 @app.post('/endTransaction/<transaction_id>/<status>')
 def endTransaction(transaction_id, status):
+    if status not in FINAL_STATUS:
+        return 'Unknown status: ' + status, 400
     try:
-        if status == 'commit':
-            transactions[transaction_id]["session"].commit()
-        elif status == 'rollback':
-            transactions[transaction_id]["session"].rollback()
-        else :
-            return 'Unknown status: ' + status, 400
-        transactions[transaction_id]["session"].close()
-        del transactions[transaction_id]
+        store.end_transaction(transaction_id, status)
         return 'Success', 200
-
+    except TransactionFinalizedException as e:
+        # A final answer: the coordinator must not retry this decision.
+        return str(e), 409
     except Exception:
         return 'failure', 400
 
-def isItemResourceAvailable(item_id):
-    for key in transactions:
-        if transactions[key]["item_id"] == item_id:
-            return False
-    return True
\ No newline at end of file
+def may_rollback(transaction_id):
+    # The coordinator log lives in the database. A stock kept in Redis only sees it when the
+    # service is given DATABASE_URL as well, without it expired reservations are always released.
+    if 'DATABASE_URL' not in os.environ:
+        return True
+    return run_transaction(get_sessionmaker(), lambda s: presume_abort_helper(s, transaction_id))
+
+reaper = TransactionReaper(
+    store.find_expired,
+    lambda transaction_id: store.end_transaction(transaction_id, 'rollback'),
+    REAPER_INTERVAL,
+    may_rollback
+)
+reaper.start()
+
+# Exposes how many expired prepared transactions were rolled back by this process.
+@app.get('/reaper_stats')
+def reaper_stats():
+    return jsonify(reaper.stats()), 200
+
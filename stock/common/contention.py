@@ -0,0 +1,66 @@
+import threading
+import time
+from collections import deque
+
+
+class ContentionMonitor:
+    """Tracks write contention per item to decide which items get sharded stock.
+
+    Every retry of a transaction on an item counts as a conflict on it. An item with
+    at least `threshold` conflicts within the last `window` seconds is hot. Whether a
+    sharded item cooled down is not decided here but from the shards in the database,
+    which all workers share.
+    """
+
+    def __init__(self, threshold, window):
+        self.threshold = threshold
+        self.window = window
+        # item id -> monotonic times of its recent conflicts
+        self.conflicts = {}
+        # items known to be in sharded mode
+        self.sharded = set()
+        self.counters = {"conflicts": 0, "sharded": 0, "unsharded": 0}
+        self.lock = threading.Lock()
+
+    def record(self, item_ids, retries):
+        if retries <= 0:
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.counters["conflicts"] += retries
+            for item_id in map(str, item_ids):
+                if item_id in self.sharded:
+                    continue
+                times = self.conflicts.setdefault(item_id, deque())
+                times.extend([now] * retries)
+                while times and times[0] < now - self.window:
+                    times.popleft()
+
+    def hot_items(self):
+        """Returns the items in single-row mode that crossed the conflict threshold."""
+        now = time.monotonic()
+        with self.lock:
+            for item_id, times in list(self.conflicts.items()):
+                while times and times[0] < now - self.window:
+                    times.popleft()
+                if not times:
+                    del self.conflicts[item_id]
+            return [item_id for item_id, times in self.conflicts.items() if len(times) >= self.threshold]
+
+    def mark_sharded(self, item_id):
+        item_id = str(item_id)
+        with self.lock:
+            self.sharded.add(item_id)
+            self.conflicts.pop(item_id, None)
+
+    def mark_unsharded(self, item_id):
+        with self.lock:
+            self.sharded.discard(str(item_id))
+
+    def count(self, event):
+        with self.lock:
+            self.counters[event] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, hot=len(self.conflicts), sharded_items=len(self.sharded))
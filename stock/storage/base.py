@@ -0,0 +1,103 @@
+class ItemNotFoundException(Exception):
+    """Exception class for handling requests for items that do not exist"""
+    def __str__(self) -> str:
+         return "No item was found"
+
+class NotEnoughStockException(Exception):
+    """Exception class for handling insufficient stock of an item"""
+    def __str__(self) -> str:
+         return "Stock cannot be negative"
+
+class TransactionNotFoundException(Exception):
+    """Exception class for handling a commit of a transaction that was never prepared"""
+    def __str__(self) -> str:
+         return "No prepared transaction was found"
+
+class TransactionFinalizedException(Exception):
+    """Exception class for handling a commit or rollback of a transaction that was decided otherwise"""
+    def __init__(self, status):
+        self.status = status
+
+    def __str__(self) -> str:
+         return f"Transaction is already {self.status}"
+
+# Status a reservation ends up in for each decision of the coordinator.
+FINAL_STATUS = {'commit': 'committed', 'rollback': 'aborted'}
+
+
+class StockStore:
+    """Storage engine of the stock service.
+
+    Item ids are passed and returned as strings. Missing items raise
+    ItemNotFoundException and decrements that would make the stock negative raise
+    NotEnoughStockException, leaving the stock untouched.
+    """
+
+    def create_item(self, price) -> str:
+        raise NotImplementedError
+
+    def create_items(self, count, price, stock) -> list:
+        """Creates `count` items with the same price and initial stock, all or none of them."""
+        raise NotImplementedError
+
+    def find_item(self, item_id) -> dict:
+        """Returns {"stock": ..., "price": ...} of the item."""
+        raise NotImplementedError
+
+    def find_items(self, item_ids):
+        """Returns {item_id: {"stock": ..., "price": ...}} of all given items and the price version
+        the prices were read under. Raises ItemNotFoundException if any of the items is missing.
+        """
+        raise NotImplementedError
+
+    def price_version(self) -> int:
+        raise NotImplementedError
+
+    def set_price(self, item_id, price):
+        """Changes the price of the item and bumps the price version."""
+        raise NotImplementedError
+
+    def add_stock(self, item_id, amount):
+        raise NotImplementedError
+
+    def remove_stock(self, item_id, amount):
+        raise NotImplementedError
+
+    def restock(self, items) -> dict:
+        """Applies the {item_id: (delta, price or None)} changes in one transaction. Items that are
+        missing or whose stock would become negative are skipped, returns their {item_id: reason}.
+        Bumps the price version if a price was changed.
+        """
+        raise NotImplementedError
+
+    def prepare_remove_stock(self, transaction_id, item_id, amount, ttl):
+        """Reserves stock of one item for the transaction, which may reserve other items with
+        further calls. Repeating the call for the same item has no effect.
+        """
+        raise NotImplementedError
+
+    def prepare_remove_stock_batch(self, transaction_id, items, ttl):
+        """Reserves the {item_id: amount} stock for the transaction, all of it or nothing.
+        Repeating the call for the same transaction has no effect.
+        """
+        raise NotImplementedError
+
+    def end_transaction(self, transaction_id, status):
+        """Finalizes ('commit') or releases ('rollback') the reservations of the transaction.
+        Repeating a decision has no effect, a rollback of an unknown transaction neither.
+        """
+        raise NotImplementedError
+
+    def find_expired(self) -> list:
+        """Returns ids of prepared transactions that passed their time to live."""
+        raise NotImplementedError
+
+    def set_shards(self, item_id, shards):
+        """Splits the stock of an item over sub-counters, if the engine has hot row contention."""
+        raise NotImplementedError("Sharding is not supported by this storage")
+
+    def start(self):
+        """Starts the background work of the engine, if it has any."""
+
+    def stats(self) -> dict:
+        return {}
@@ -0,0 +1,461 @@
+import os
+import random
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, bindparam, func, values, column, cast, String, Integer, Float
+from sqlalchemy_cockroachdb import run_transaction
+from sqlalchemy.orm.exc import NoResultFound
+
+from orm_models.models import Stock, StockShard, StockReservation, PriceVersion
+from common.db import get_engine, get_sessionmaker
+from common.contention import ContentionMonitor
+from storage.base import (
+    StockStore, ItemNotFoundException, NotEnoughStockException,
+    TransactionNotFoundException, TransactionFinalizedException, FINAL_STATUS
+)
+
+# Stock of hot items can be split over STOCK_SHARDS sub-counter rows. With STOCK_SHARDING=auto an item
+# is sharded after HOT_ITEM_CONFLICTS transaction retries within HOT_ITEM_WINDOW seconds and moved
+# back to a single row once none of its shards was written for SHARD_COOLDOWN seconds. The default
+# 'off' leaves the mode of every item to the /item/shards endpoint.
+STOCK_SHARDING = os.environ.get('STOCK_SHARDING', 'off')
+STOCK_SHARDS = int(os.environ.get('STOCK_SHARDS', 8))
+HOT_ITEM_CONFLICTS = int(os.environ.get('HOT_ITEM_CONFLICTS', 5))
+HOT_ITEM_WINDOW = float(os.environ.get('HOT_ITEM_WINDOW', 10))
+SHARD_COOLDOWN = float(os.environ.get('SHARD_COOLDOWN', 60))
+SHARD_CHECK_INTERVAL = float(os.environ.get('SHARD_CHECK_INTERVAL', 5))
+
+# The single row of the price_versions table.
+PRICE_VERSION_ID = 1
+
+stocks = Stock.__table__
+stock_shards = StockShard.__table__
+price_versions = PriceVersion.__table__
+
+# Stock of an item is the stock of its row plus the stock of its shards, if it has any.
+total_stock = (
+    stocks.c.stock + func.coalesce(
+        select(func.sum(stock_shards.c.stock))
+        .where(stock_shards.c.item_id == stocks.c.item_id)
+        .scalar_subquery(),
+        0
+    )
+).label('stock')
+
+# Pre-built Core statements for the hot endpoints. SQLAlchemy caches their compiled form
+# and executing them on a plain connection skips the ORM identity map and unit of work.
+create_item_stmt = stocks.insert()
+find_item_stmt = select(total_stock, stocks.c.price).where(stocks.c.item_id == bindparam('item_id'))
+find_items_stmt = select(stocks.c.item_id, total_stock, stocks.c.price) \
+    .where(stocks.c.item_id.in_(bindparam('item_ids', expanding=True)))
+price_version_stmt = select(price_versions.c.version).where(price_versions.c.id == PRICE_VERSION_ID)
+
+contention = ContentionMonitor(HOT_ITEM_CONFLICTS, HOT_ITEM_WINDOW)
+
+def find_item_helper(conn, item_id):
+    item = conn.execute(find_item_stmt, {"item_id": item_id}).one()
+    return item
+
+def find_items_helper(conn, item_ids):
+    items = conn.execute(find_items_stmt, {"item_ids": item_ids}).all()
+    return items, price_version_helper(conn)
+
+def price_version_helper(conn):
+    return conn.execute(price_version_stmt).scalar() or 0
+
+def set_price_helper(session, item_id, price):
+    updated = session.execute(
+        stocks.update()
+        .where(stocks.c.item_id == item_id)
+        .values(price=price)
+        .returning(stocks.c.item_id)
+    ).first()
+    if updated is None:
+        raise NoResultFound("No row was found when one was required")
+    # The price change and the new version commit together.
+    bump_price_version_helper(session)
+
+def bump_price_version_helper(session):
+    bumped = session.execute(
+        price_versions.update()
+        .where(price_versions.c.id == PRICE_VERSION_ID)
+        .values(version=price_versions.c.version + 1)
+        .returning(price_versions.c.version)
+    ).first()
+    if bumped is None:
+        session.execute(price_versions.insert().values(id=PRICE_VERSION_ID, version=1))
+
+
+# Stock is changed with single conditional statements instead of a read-modify-write
+# of the item row, which halves the round trips and avoids most serialization retries.
+def add_stock_helper(session, item_id, amount):
+    updated = session.execute(
+        stocks.update()
+        .where(stocks.c.item_id == item_id, stocks.c.shards == 0)
+        .values(stock=stocks.c.stock + amount)
+        .returning(stocks.c.stock)
+    ).first()
+    if updated is None:
+        shards = item_shards_helper(session, item_id)
+        session.execute(
+            stock_shards.update()
+            .where(stock_shards.c.item_id == item_id, stock_shards.c.shard == random.randrange(shards))
+            .values(stock=stock_shards.c.stock + amount)
+        )
+
+def restock_helper(session, items):
+    """Applies {item_id: (delta, price or None)} to all items in single-row mode with one
+    UPDATE ... FROM VALUES, the few sharded items go through their sub-counters one by one.
+    """
+    changes = values(
+        column('item_id', String), column('delta', Integer), column('price', Float), name='changes'
+    ).data([(item_id, delta, price) for item_id, (delta, price) in items.items()])
+    updated = session.execute(
+        stocks.update()
+        .where(
+            stocks.c.item_id == cast(changes.c.item_id, stocks.c.item_id.type),
+            stocks.c.shards == 0,
+            stocks.c.stock + changes.c.delta >= 0
+        )
+        .values(stock=stocks.c.stock + changes.c.delta, price=func.coalesce(cast(changes.c.price, Float), stocks.c.price))
+        .returning(stocks.c.item_id)
+    ).all()
+
+    rejected = {}
+    updated_ids = {str(row.item_id) for row in updated}
+    skipped = [item_id for item_id in items if item_id not in updated_ids]
+    if skipped:
+        shards = {
+            str(row.item_id): row.shards
+            for row in session.execute(select(stocks.c.item_id, stocks.c.shards).where(stocks.c.item_id.in_(skipped)))
+        }
+        for item_id in skipped:
+            delta, price = items[item_id]
+            if item_id not in shards:
+                rejected[item_id] = str(ItemNotFoundException())
+                continue
+            if not shards[item_id]:
+                rejected[item_id] = str(NotEnoughStockException())
+                continue
+            try:
+                if delta >= 0:
+                    add_stock_helper(session, item_id, delta)
+                else:
+                    remove_stock_helper(session, item_id, -delta)
+            except NotEnoughStockException as e:
+                # Nothing was taken from the shards yet.
+                rejected[item_id] = str(e)
+                continue
+            if price is not None:
+                session.execute(stocks.update().where(stocks.c.item_id == item_id).values(price=price))
+
+    if any(price is not None for item_id, (_, price) in items.items() if item_id not in rejected):
+        bump_price_version_helper(session)
+    return rejected
+
+def item_shards_helper(session, item_id):
+    """Returns the number of shards of a sharded item.
+    Called after a conditional statement on the item row did not match, so an item
+    in single-row mode is out of stock and a missing one raises NoResultFound.
+    """
+    shards = session.execute(select(stocks.c.shards).where(stocks.c.item_id == item_id)).one().shards
+    if not shards:
+        raise NotEnoughStockException()
+    contention.mark_sharded(item_id)
+    return shards
+
+def remove_stock_helper(session, item_id, amount):
+    updated = session.execute(
+        stocks.update()
+        .where(stocks.c.item_id == item_id, stocks.c.shards == 0, stocks.c.stock >= amount)
+        .values(stock=stocks.c.stock - amount)
+        .returning(stocks.c.stock)
+    ).first()
+    if updated is None:
+        # Nothing was updated: the item is missing, out of stock or sharded.
+        remove_sharded_stock_helper(session, item_id, amount, item_shards_helper(session, item_id))
+
+def remove_sharded_stock_helper(session, item_id, amount, shards):
+    # Start at a random shard, so concurrent decrements spread over all of them.
+    start = random.randrange(shards)
+    for offset in range(shards):
+        updated = session.execute(
+            stock_shards.update()
+            .where(
+                stock_shards.c.item_id == item_id,
+                stock_shards.c.shard == (start + offset) % shards,
+                stock_shards.c.stock >= amount
+            )
+            .values(stock=stock_shards.c.stock - amount)
+            .returning(stock_shards.c.stock)
+        ).first()
+        if updated is not None:
+            return
+
+    # No single shard holds enough, take the amount from several of them.
+    rows = session.execute(
+        select(stock_shards.c.shard, stock_shards.c.stock)
+        .where(stock_shards.c.item_id == item_id, stock_shards.c.stock > 0)
+        .order_by(stock_shards.c.shard)
+        .with_for_update()
+    ).all()
+    if sum(row.stock for row in rows) < amount:
+        raise NotEnoughStockException()
+    for row in rows:
+        taken = min(row.stock, amount)
+        session.execute(
+            stock_shards.update()
+            .where(stock_shards.c.item_id == item_id, stock_shards.c.shard == row.shard)
+            .values(stock=stock_shards.c.stock - taken)
+        )
+        amount -= taken
+        if amount == 0:
+            return
+
+def shard_item_helper(session, item_id, shards):
+    """Spreads the stock of an item in single-row mode over the given number of shards."""
+    item = session.execute(
+        select(stocks.c.stock).where(stocks.c.item_id == item_id, stocks.c.shards == 0).with_for_update()
+    ).first()
+    if item is None:
+        return False
+    share, rest = divmod(item.stock, shards)
+    session.execute(stock_shards.insert(), [
+        {"item_id": item_id, "shard": shard, "stock": share + (1 if shard < rest else 0)}
+        for shard in range(shards)
+    ])
+    session.execute(stocks.update().where(stocks.c.item_id == item_id).values(stock=0, shards=shards))
+    return True
+
+def unshard_item_helper(session, item_id):
+    """Moves the stock of a sharded item back into its row."""
+    removed = session.execute(
+        stock_shards.delete().where(stock_shards.c.item_id == item_id).returning(stock_shards.c.stock)
+    ).all()
+    session.execute(
+        stocks.update()
+        .where(stocks.c.item_id == item_id)
+        .values(stock=stocks.c.stock + sum(row.stock for row in removed), shards=0)
+    )
+    return bool(removed)
+
+def idle_sharded_items_helper(session, idle_since):
+    """Returns sharded items none of whose shards was written since `idle_since`."""
+    rows = session.execute(
+        select(stock_shards.c.item_id)
+        .group_by(stock_shards.c.item_id)
+        .having(func.max(stock_shards.c.updated_at) < idle_since)
+        .limit(100)
+    ).all()
+    return [row.item_id for row in rows]
+
+def unshard_idle_item_helper(session, item_id, idle_since):
+    # Checked again in the transaction, another worker may have written a shard meanwhile.
+    last_write = session.execute(
+        select(func.max(stock_shards.c.updated_at)).where(stock_shards.c.item_id == item_id)
+    ).scalar()
+    if last_write is None or last_write >= idle_since:
+        return False
+    return unshard_item_helper(session, item_id)
+
+def set_item_shards_helper(session, item_id, shards):
+    session.execute(select(stocks.c.item_id).where(stocks.c.item_id == item_id)).one()
+    unshard_item_helper(session, item_id)
+    if shards > 0:
+        shard_item_helper(session, item_id, shards)
+
+def run_tracked(item_ids, callback):
+    """run_transaction that reports every retry of the callback as a conflict on the items."""
+    attempts = 0
+    def attempt(session):
+        nonlocal attempts
+        attempts += 1
+        return callback(session)
+    try:
+        return run_transaction(get_sessionmaker(), attempt)
+    finally:
+        contention.record(item_ids, attempts - 1)
+
+def balance_shards():
+    """Shards the items that became hot and moves the ones that cooled down back to a single row."""
+    while True:
+        time.sleep(SHARD_CHECK_INTERVAL)
+        try:
+            for item_id in contention.hot_items():
+                if run_transaction(get_sessionmaker(), lambda s: shard_item_helper(s, item_id, STOCK_SHARDS)):
+                    contention.count("sharded")
+                contention.mark_sharded(item_id)
+            # The cool-down is read from the shards, so it does not depend on what this worker saw.
+            idle_since = datetime.utcnow() - timedelta(seconds=SHARD_COOLDOWN)
+            for item_id in run_transaction(get_sessionmaker(), lambda s: idle_sharded_items_helper(s, idle_since)):
+                if run_transaction(get_sessionmaker(), lambda s: unshard_idle_item_helper(s, item_id, idle_since)):
+                    contention.count("unsharded")
+                contention.mark_unsharded(item_id)
+        except Exception:
+            traceback.print_exc()
+
+def prepare_remove_stock_helper(session, transaction_id, item_id, amount, ttl):
+    reservation = session.query(StockReservation).filter(
+        StockReservation.transaction_id == transaction_id,
+        StockReservation.item_id == item_id
+    ).first()
+    if reservation:
+        # Prepare was already done, e.g. a retried request.
+        return
+
+    remove_stock_helper(session, item_id, amount)
+    session.add(StockReservation(
+        transaction_id=transaction_id,
+        item_id=item_id,
+        amount=amount,
+        expires_at=datetime.utcnow() + timedelta(seconds=ttl)
+    ))
+
+def prepare_remove_stock_batch_helper(session, transaction_id, items, ttl):
+    reservation = session.query(StockReservation).filter(
+        StockReservation.transaction_id == transaction_id
+    ).first()
+    if reservation:
+        # Prepare was already done, e.g. a retried request.
+        return
+
+    expires_at = datetime.utcnow() + timedelta(seconds=ttl)
+    # Rows are always locked in item id order, so concurrent checkouts
+    # of overlapping carts cannot deadlock on each other.
+    for item_id in sorted(items, key=uuid.UUID):
+        remove_stock_helper(session, item_id, items[item_id])
+    session.add_all([
+        StockReservation(transaction_id=transaction_id, item_id=item_id, amount=amount, expires_at=expires_at)
+        for item_id, amount in items.items()
+    ])
+
+def end_transaction_helper(session, transaction_id, status):
+    reservations = session.query(StockReservation).filter(
+        StockReservation.transaction_id == transaction_id
+    ).all()
+    if not reservations and status == 'commit':
+        raise NoResultFound("No row was found when one was required")
+
+    for reservation in reservations:
+        if reservation.status != 'prepared':
+            if reservation.status != FINAL_STATUS[status]:
+                raise TransactionFinalizedException(reservation.status)
+            # Already finalized, e.g. a retried request.
+            continue
+        if status == 'rollback':
+            add_stock_helper(session, reservation.item_id, reservation.amount)
+        reservation.status = FINAL_STATUS[status]
+
+def find_expired_helper(session):
+    expired = session.query(StockReservation.transaction_id).filter(
+        StockReservation.status == 'prepared',
+        StockReservation.expires_at < datetime.utcnow()
+    ).distinct().limit(100).all()
+    return [row.transaction_id for row in expired]
+
+
+class CockroachStockStore(StockStore):
+    """Durable stock storage in CockroachDB.
+
+    Reservations of prepared transactions live in the stock_reservations table, so
+    any worker or replica can finish them. Hot items are sharded over stock_shards rows.
+    """
+
+    def create_item(self, price) -> str:
+        item_uuid = uuid.uuid4()
+        run_transaction(
+            get_engine(),
+            lambda conn: conn.execute(create_item_stmt, {"item_id": item_uuid, "stock": 0, "price": float(price)})
+        )
+        return str(item_uuid)
+
+    def create_items(self, count, price, stock) -> list:
+        item_uuids = [uuid.uuid4() for _ in range(count)]
+        # Executed as multi-row inserts by the driver.
+        run_transaction(
+            get_engine(),
+            lambda conn: conn.execute(create_item_stmt, [
+                {"item_id": item_uuid, "stock": stock, "price": float(price)} for item_uuid in item_uuids
+            ])
+        )
+        return [str(item_uuid) for item_uuid in item_uuids]
+
+    def find_item(self, item_id) -> dict:
+        try:
+            item = run_transaction(get_engine(), lambda conn: find_item_helper(conn, item_id))
+        except NoResultFound:
+            raise ItemNotFoundException()
+        return {"stock": item.stock, "price": item.price}
+
+    def find_items(self, item_ids):
+        items, version = run_transaction(get_engine(), lambda conn: find_items_helper(conn, item_ids))
+        if len(items) != len(set(item_ids)):
+            raise ItemNotFoundException()
+        return {str(item.item_id): {"stock": item.stock, "price": item.price} for item in items}, version
+
+    def price_version(self) -> int:
+        return run_transaction(get_engine(), price_version_helper)
+
+    def set_price(self, item_id, price):
+        try:
+            run_transaction(get_sessionmaker(), lambda s: set_price_helper(s, item_id, price))
+        except NoResultFound:
+            raise ItemNotFoundException()
+
+    def add_stock(self, item_id, amount):
+        try:
+            run_tracked([item_id], lambda s: add_stock_helper(s, item_id, amount))
+        except NoResultFound:
+            raise ItemNotFoundException()
+
+    def remove_stock(self, item_id, amount):
+        try:
+            run_tracked([item_id], lambda s: remove_stock_helper(s, item_id, amount))
+        except NoResultFound:
+            raise ItemNotFoundException()
+
+    def restock(self, items) -> dict:
+        # Not tracked for contention: a retry of a large batch says little about single items.
+        return run_transaction(get_sessionmaker(), lambda s: restock_helper(s, items))
+
+    def prepare_remove_stock(self, transaction_id, item_id, amount, ttl):
+        try:
+            run_tracked([item_id], lambda s: prepare_remove_stock_helper(s, transaction_id, item_id, amount, ttl))
+        except NoResultFound:
+            raise ItemNotFoundException()
+
+    def prepare_remove_stock_batch(self, transaction_id, items, ttl):
+        try:
+            run_tracked(list(items), lambda s: prepare_remove_stock_batch_helper(s, transaction_id, items, ttl))
+        except NoResultFound:
+            raise ItemNotFoundException()
+
+    def end_transaction(self, transaction_id, status):
+        try:
+            run_transaction(get_sessionmaker(), lambda s: end_transaction_helper(s, transaction_id, status))
+        except NoResultFound:
+            raise TransactionNotFoundException()
+
+    def find_expired(self) -> list:
+        return run_transaction(get_sessionmaker(), find_expired_helper)
+
+    def set_shards(self, item_id, shards):
+        try:
+            run_transaction(get_sessionmaker(), lambda s: set_item_shards_helper(s, item_id, shards))
+        except NoResultFound:
+            raise ItemNotFoundException()
+        if shards > 0:
+            contention.mark_sharded(item_id)
+        else:
+            contention.mark_unsharded(item_id)
+
+    def start(self):
+        if STOCK_SHARDING == 'auto':
+            threading.Thread(target=balance_shards, name="stock-shard-balancer", daemon=True).start()
+
+    def stats(self) -> dict:
+        return contention.stats()
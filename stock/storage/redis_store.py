@@ -0,0 +1,240 @@
+import os
+import time
+import uuid
+
+import redis
+
+from storage.base import (
+    StockStore, ItemNotFoundException, NotEnoughStockException,
+    TransactionNotFoundException, TransactionFinalizedException, FINAL_STATUS
+)
+
+# Seconds a finished transaction is remembered, so retried decisions are still answered.
+FINISHED_TX_TTL = int(os.environ.get('FINISHED_TX_TTL', 24 * 3600))
+
+# Keys:
+#   item:<item_id>       hash {stock, price}
+#   price_version        integer
+#   tx:<transaction_id>  hash {item_id: reserved amount, ...} plus the field "$status"
+#   tx_expiry            sorted set of prepared transaction ids, scored by their deadline
+# The scripts below make every change atomic: a script runs in isolation on the server.
+
+ADD_STOCK = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -1 end
+return redis.call('HINCRBY', KEYS[1], 'stock', ARGV[1])
+"""
+
+REMOVE_STOCK = """
+local stock = redis.call('HGET', KEYS[1], 'stock')
+if not stock then return -1 end
+if tonumber(stock) < tonumber(ARGV[1]) then return -2 end
+return redis.call('HINCRBY', KEYS[1], 'stock', -tonumber(ARGV[1]))
+"""
+
+SET_PRICE = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -1 end
+redis.call('HSET', KEYS[1], 'price', ARGV[1])
+return redis.call('INCR', KEYS[2])
+"""
+
+# KEYS: price_version, item keys...  ARGV: per item delta and price ('' keeps the price)
+# Returns the indexes of the skipped items with -1 (missing) or -2 (stock would go negative).
+RESTOCK = """
+local rejected = {}
+local price_changed = false
+for i = 2, #KEYS do
+    local stock = redis.call('HGET', KEYS[i], 'stock')
+    local delta = tonumber(ARGV[2 * i - 3])
+    local price = ARGV[2 * i - 2]
+    if not stock then
+        table.insert(rejected, i - 1)
+        table.insert(rejected, -1)
+    elseif tonumber(stock) + delta < 0 then
+        table.insert(rejected, i - 1)
+        table.insert(rejected, -2)
+    else
+        redis.call('HINCRBY', KEYS[i], 'stock', delta)
+        if price ~= '' then
+            redis.call('HSET', KEYS[i], 'price', price)
+            price_changed = true
+        end
+    end
+end
+if price_changed then redis.call('INCR', KEYS[1]) end
+return rejected
+"""
+
+# KEYS: tx, tx_expiry, item keys...  ARGV: transaction id, deadline, per item flag, amounts...
+# Checks all items before touching any of them, so the reservation is all or nothing.
+PREPARE = """
+local per_item = ARGV[3] == '1'
+local status = redis.call('HGET', KEYS[1], '$status')
+if status and status ~= 'prepared' then return -3 end
+if status and not per_item then return 0 end
+local todo = {}
+for i = 3, #KEYS do
+    local item_id = string.sub(KEYS[i], 6)
+    local amount = tonumber(ARGV[i + 1])
+    if not (per_item and redis.call('HEXISTS', KEYS[1], item_id) == 1) then
+        local stock = redis.call('HGET', KEYS[i], 'stock')
+        if not stock then return -1 end
+        if tonumber(stock) < amount then return -2 end
+        table.insert(todo, {KEYS[i], item_id, amount})
+    end
+end
+for _, item in ipairs(todo) do
+    redis.call('HINCRBY', item[1], 'stock', -item[3])
+    redis.call('HSET', KEYS[1], item[2], item[3])
+end
+if not status then
+    redis.call('HSET', KEYS[1], '$status', 'prepared')
+    redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+end
+return 0
+"""
+
+# KEYS: tx, tx_expiry  ARGV: transaction id, final status, ttl of the finished transaction
+# Returns 0 when done, -1 for an unknown transaction, -3 when it was decided otherwise.
+END_TRANSACTION = """
+local status = redis.call('HGET', KEYS[1], '$status')
+if not status then return -1 end
+if status ~= 'prepared' then
+    if status == ARGV[2] then return 0 end
+    return -3
+end
+if ARGV[2] == 'aborted' then
+    local reserved = redis.call('HGETALL', KEYS[1])
+    for i = 1, #reserved, 2 do
+        if reserved[i] ~= '$status' then
+            redis.call('HINCRBY', 'item:' .. reserved[i], 'stock', reserved[i + 1])
+        end
+    end
+end
+redis.call('HSET', KEYS[1], '$status', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('ZREM', KEYS[2], ARGV[1])
+return 0
+"""
+
+
+def item_key(item_id):
+    return f"item:{item_id}"
+
+def tx_key(transaction_id):
+    return f"tx:{transaction_id}"
+
+TX_EXPIRY_KEY = 'tx_expiry'
+PRICE_VERSION_KEY = 'price_version'
+
+
+class RedisStockStore(StockStore):
+    """In-memory stock storage in Redis, every change runs as a single Lua script.
+
+    Meant for a single Redis server: the rollback script touches item keys that are
+    only known from the reservation, which Redis Cluster would not allow.
+    """
+
+    def __init__(self):
+        self.db = redis.Redis(
+            host=os.environ.get('REDIS_HOST', 'localhost'),
+            port=int(os.environ.get('REDIS_PORT', 6379)),
+            password=os.environ.get('REDIS_PASSWORD'),
+            db=int(os.environ.get('REDIS_DB', 0)),
+            decode_responses=True
+        )
+        self.add_script = self.db.register_script(ADD_STOCK)
+        self.remove_script = self.db.register_script(REMOVE_STOCK)
+        self.set_price_script = self.db.register_script(SET_PRICE)
+        self.restock_script = self.db.register_script(RESTOCK)
+        self.prepare_script = self.db.register_script(PREPARE)
+        self.end_script = self.db.register_script(END_TRANSACTION)
+
+    @staticmethod
+    def check(result):
+        if result == -1:
+            raise ItemNotFoundException()
+        if result == -2:
+            raise NotEnoughStockException()
+        return result
+
+    def create_item(self, price) -> str:
+        item_id = str(uuid.uuid4())
+        self.db.hset(item_key(item_id), mapping={"stock": 0, "price": float(price)})
+        return item_id
+
+    def create_items(self, count, price, stock) -> list:
+        item_ids = [str(uuid.uuid4()) for _ in range(count)]
+        pipeline = self.db.pipeline(transaction=True)
+        for item_id in item_ids:
+            pipeline.hset(item_key(item_id), mapping={"stock": stock, "price": float(price)})
+        pipeline.execute()
+        return item_ids
+
+    def find_item(self, item_id) -> dict:
+        stock, price = self.db.hmget(item_key(item_id), "stock", "price")
+        if stock is None:
+            raise ItemNotFoundException()
+        return {"stock": int(stock), "price": float(price)}
+
+    def find_items(self, item_ids):
+        pipeline = self.db.pipeline()
+        for item_id in item_ids:
+            pipeline.hmget(item_key(item_id), "stock", "price")
+        pipeline.get(PRICE_VERSION_KEY)
+        *rows, version = pipeline.execute()
+        if any(stock is None for stock, _ in rows):
+            raise ItemNotFoundException()
+        items = {
+            str(item_id): {"stock": int(stock), "price": float(price)}
+            for item_id, (stock, price) in zip(item_ids, rows)
+        }
+        return items, int(version or 0)
+
+    def price_version(self) -> int:
+        return int(self.db.get(PRICE_VERSION_KEY) or 0)
+
+    def set_price(self, item_id, price):
+        self.check(self.set_price_script(keys=[item_key(item_id), PRICE_VERSION_KEY], args=[float(price)]))
+
+    def add_stock(self, item_id, amount):
+        self.check(self.add_script(keys=[item_key(item_id)], args=[amount]))
+
+    def remove_stock(self, item_id, amount):
+        self.check(self.remove_script(keys=[item_key(item_id)], args=[amount]))
+
+    def restock(self, items) -> dict:
+        item_ids = list(items)
+        args = []
+        for delta, price in items.values():
+            args += [delta, '' if price is None else float(price)]
+        result = self.restock_script(keys=[PRICE_VERSION_KEY] + [item_key(item_id) for item_id in item_ids], args=args)
+        reasons = {-1: str(ItemNotFoundException()), -2: str(NotEnoughStockException())}
+        return {item_ids[index - 1]: reasons[code] for index, code in zip(result[::2], result[1::2])}
+
+    def _prepare(self, transaction_id, items, ttl, per_item):
+        result = self.prepare_script(
+            keys=[tx_key(transaction_id), TX_EXPIRY_KEY] + [item_key(item_id) for item_id in items],
+            args=[transaction_id, time.time() + ttl, '1' if per_item else '0'] + list(items.values())
+        )
+        if result == -3:
+            raise TransactionFinalizedException(self.db.hget(tx_key(transaction_id), '$status'))
+        self.check(result)
+
+    def prepare_remove_stock(self, transaction_id, item_id, amount, ttl):
+        self._prepare(transaction_id, {str(item_id): amount}, ttl, per_item=True)
+
+    def prepare_remove_stock_batch(self, transaction_id, items, ttl):
+        self._prepare(transaction_id, items, ttl, per_item=False)
+
+    def end_transaction(self, transaction_id, status):
+        result = self.end_script(
+            keys=[tx_key(transaction_id), TX_EXPIRY_KEY],
+            args=[transaction_id, FINAL_STATUS[status], FINISHED_TX_TTL]
+        )
+        if result == -1 and status == 'commit':
+            raise TransactionNotFoundException()
+        if result == -3:
+            raise TransactionFinalizedException(self.db.hget(tx_key(transaction_id), '$status'))
+
+    def find_expired(self) -> list:
+        return self.db.zrangebyscore(TX_EXPIRY_KEY, '-inf', time.time(), start=0, num=100)
@@ -1,4 +1,6 @@
+import time
 import unittest
+import uuid
 
 import utils as tu
 
@@ -34,6 +36,87 @@ class TestMicroservices(unittest.TestCase):
         stock_after_subtract: int = tu.find_item(item_id)['stock']
         self.assertEqual(stock_after_subtract, 35)
 
+    def test_stock_batch(self):
+        item_id1: str = tu.create_item(5)['item_id']
+        item_id2: str = tu.create_item(7)['item_id']
+        add_stock_response = tu.add_stock(item_id2, 3)
+        self.assertTrue(tu.status_code_is_success(add_stock_response))
+
+        # Test /stock/find_batch
+        items: dict = tu.find_items([item_id1, item_id2, item_id1]).json()['items']
+        self.assertEqual(len(items), 2)
+        self.assertEqual(items[item_id1]['price'], 5)
+        self.assertEqual(items[item_id2]['price'], 7)
+        self.assertEqual(items[item_id2]['stock'], 3)
+
+        # Unknown items fail the whole lookup
+        find_response = tu.find_items([item_id1, "00000000-0000-0000-0000-000000000000"])
+        self.assertTrue(tu.status_code_is_failure(find_response.status_code))
+
+    def test_stock_sharded(self):
+        item_id: str = tu.create_item(5)['item_id']
+        add_stock_response = tu.add_stock(item_id, 10)
+        self.assertTrue(tu.status_code_is_success(add_stock_response))
+
+        shards_response = tu.set_item_shards(item_id, 4)
+        if shards_response == 501:
+            self.skipTest("The stock storage does not support sharding")
+        self.assertTrue(tu.status_code_is_success(shards_response))
+        self.assertEqual(tu.find_item(item_id)['stock'], 10)
+
+        # More than any single shard holds
+        subtract_stock_response = tu.subtract_stock(item_id, 7)
+        self.assertTrue(tu.status_code_is_success(subtract_stock_response))
+        self.assertEqual(tu.find_item(item_id)['stock'], 3)
+
+        subtract_stock_response = tu.subtract_stock(item_id, 4)
+        self.assertTrue(tu.status_code_is_failure(subtract_stock_response))
+
+        add_stock_response = tu.add_stock(item_id, 2)
+        self.assertTrue(tu.status_code_is_success(add_stock_response))
+
+        shards_response = tu.set_item_shards(item_id, 0)
+        self.assertTrue(tu.status_code_is_success(shards_response))
+        self.assertEqual(tu.find_item(item_id)['stock'], 5)
+
+    def test_stock_idempotency(self):
+        item_id: str = tu.create_item(5)['item_id']
+        add_stock_response = tu.add_stock(item_id, 10)
+        self.assertTrue(tu.status_code_is_success(add_stock_response))
+
+        # A retried request is answered from the stored response and applied once
+        idempotency_key: str = str(uuid.uuid4())
+        for _ in range(2):
+            subtract_stock_response = tu.subtract_stock(item_id, 3, idempotency_key)
+            self.assertTrue(tu.status_code_is_success(subtract_stock_response))
+        self.assertEqual(tu.find_item(item_id)['stock'], 7)
+
+        # The same key cannot be reused for another request
+        subtract_stock_response = tu.subtract_stock(item_id, 4, idempotency_key)
+        self.assertTrue(tu.status_code_is_failure(subtract_stock_response))
+        self.assertEqual(tu.find_item(item_id)['stock'], 7)
+
+    def test_stock_bulk_create(self):
+        item_ids: list = tu.create_items(25, 4, 3)
+        self.assertEqual(len(set(item_ids)), 25)
+        self.assertEqual(tu.find_item(item_ids[-1]), {'price': 4, 'stock': 3})
+
+    def test_stock_restock(self):
+        item_id1: str = tu.create_item(5)['item_id']
+        item_id2: str = tu.create_item(3)['item_id']
+
+        progress: list = tu.restock(
+            "item_id,delta,price\n"
+            f"{item_id1},10\n"
+            f"{item_id2},4,7\n"
+            f"{item_id1},-20\n"
+            "not-an-item,1\n"
+        )
+        self.assertEqual(progress[-1], {'done': True, 'batches': 1, 'applied': 2, 'rejected': 2})
+        self.assertEqual([rejection['line'] for rejection in progress[0]['rejected']], [4, 5])
+        self.assertEqual(tu.find_item(item_id1), {'price': 5, 'stock': 10})
+        self.assertEqual(tu.find_item(item_id2), {'price': 7, 'stock': 4})
+
     def test_payment(self):
         # Test /payment/pay/<user_id>/<order_id>
         user: dict = tu.create_user()
@@ -74,6 +157,11 @@ class TestMicroservices(unittest.TestCase):
         credit_after_payment: int = tu.find_user(user_id)['credit']
         self.assertEqual(credit_after_payment, 5)
 
+    def test_payment_bulk_create(self):
+        user_ids: list = tu.create_users(25, 10)
+        self.assertEqual(len(set(user_ids)), 25)
+        self.assertEqual(tu.find_user(user_ids[-1])['credit'], 10)
+
     def test_order(self):
         # Test /payment/pay/<user_id>/<order_id>
         user: dict = tu.create_user()
@@ -134,6 +222,7 @@ class TestMicroservices(unittest.TestCase):
 
         checkout_response = tu.checkout_order(order_id).status_code
         self.assertTrue(tu.status_code_is_success(checkout_response))
+        self.assertTrue(tu.find_order(order_id)['paid'])
 
         stock_after_subtract: int = tu.find_item(item_id1)['stock']
         self.assertEqual(stock_after_subtract, 14)
@@ -141,6 +230,137 @@ class TestMicroservices(unittest.TestCase):
         credit: int = tu.find_user(user_id)['credit']
         self.assertEqual(credit, 5)
 
+    def test_order_saga(self):
+        user_id: str = tu.create_user()['user_id']
+        order_id: str = tu.create_order(user_id)['order_id']
+
+        item_id1: str = tu.create_item(5)['item_id']
+        add_stock_response = tu.add_stock(item_id1, 15)
+        self.assertTrue(tu.status_code_is_success(add_stock_response))
+        item_id2: str = tu.create_item(5)['item_id']
+
+        add_item_response = tu.add_item_to_order(order_id, item_id1)
+        self.assertTrue(tu.status_code_is_success(add_item_response))
+        add_item_response = tu.add_item_to_order(order_id, item_id2)
+        self.assertTrue(tu.status_code_is_success(add_item_response))
+
+        add_credit_response = tu.add_credit_to_user(user_id, 15)
+        self.assertTrue(tu.status_code_is_success(int(add_credit_response)))
+
+        # Item 2 is out of stock, the payment and item 1 get compensated
+        checkout_response = tu.checkout_order(order_id, 'saga').status_code
+        self.assertTrue(tu.status_code_is_failure(checkout_response))
+
+        self.assertEqual(tu.find_item(item_id1)['stock'], 15)
+        self.assertEqual(tu.find_user(user_id)['credit'], 15)
+
+        add_stock_response = tu.add_stock(item_id2, 1)
+        self.assertTrue(tu.status_code_is_success(add_stock_response))
+
+        checkout_response = tu.checkout_order(order_id, 'saga').status_code
+        self.assertTrue(tu.status_code_is_success(checkout_response))
+
+        self.assertEqual(tu.find_item(item_id1)['stock'], 14)
+        self.assertEqual(tu.find_item(item_id2)['stock'], 0)
+        self.assertEqual(tu.find_user(user_id)['credit'], 5)
+        self.assertTrue(tu.find_order(order_id)['paid'])
+
+    def test_order_async(self):
+        user_id: str = tu.create_user()['user_id']
+        order_id: str = tu.create_order(user_id)['order_id']
+        item_id: str = tu.create_item(5)['item_id']
+        add_stock_response = tu.add_stock(item_id, 1)
+        self.assertTrue(tu.status_code_is_success(add_stock_response))
+        add_item_response = tu.add_item_to_order(order_id, item_id)
+        self.assertTrue(tu.status_code_is_success(add_item_response))
+        add_credit_response = tu.add_credit_to_user(user_id, 5)
+        self.assertTrue(tu.status_code_is_success(add_credit_response))
+
+        checkout_response = tu.checkout_order(order_id, asynchronous=True)
+        self.assertEqual(checkout_response.status_code, 202)
+        job_id: str = checkout_response.json()['job_id']
+
+        status: dict = tu.checkout_status(job_id)
+        for _ in range(50):
+            if status['status'] in ('succeeded', 'failed'):
+                break
+            time.sleep(0.1)
+            status = tu.checkout_status(job_id)
+        self.assertEqual(status['status'], 'succeeded')
+        self.assertEqual(tu.find_item(item_id)['stock'], 0)
+        self.assertTrue(tu.find_order(order_id)['paid'])
+
+    def test_order_price_change(self):
+        user_id: str = tu.create_user()['user_id']
+        order_id: str = tu.create_order(user_id)['order_id']
+        item_id: str = tu.create_item(5)['item_id']
+
+        add_item_response = tu.add_item_to_order(order_id, item_id)
+        self.assertTrue(tu.status_code_is_success(add_item_response))
+        self.assertEqual(tu.find_order(order_id)['total_cost'], 5)
+
+        set_price_response = tu.set_item_price(item_id, 8)
+        self.assertTrue(tu.status_code_is_success(set_price_response))
+
+        # Cached prices are dropped once the order service sees the new price version,
+        # items already in the cart keep the price they were added with
+        time.sleep(2)
+        add_item_response = tu.add_item_to_order(order_id, item_id)
+        self.assertTrue(tu.status_code_is_success(add_item_response))
+        self.assertEqual(tu.find_order(order_id)['total_cost'], 13)
+
+    def test_order_totals(self):
+        user_id: str = tu.create_user()['user_id']
+        order_id: str = tu.create_order(user_id)['order_id']
+        item_id1: str = tu.create_item(5)['item_id']
+        item_id2: str = tu.create_item(3)['item_id']
+
+        for item_id in (item_id1, item_id1, item_id2):
+            add_item_response = tu.add_item_to_order(order_id, item_id)
+            self.assertTrue(tu.status_code_is_success(add_item_response))
+        order: dict = tu.find_order(order_id)
+        self.assertEqual(order['total_cost'], 13)
+        self.assertEqual(order['quantities'], {item_id1: 2, item_id2: 1})
+
+        remove_item_response = tu.remove_item_from_order(order_id, item_id1)
+        self.assertTrue(tu.status_code_is_success(remove_item_response))
+        order = tu.find_order(order_id)
+        self.assertEqual(order['items'], [item_id2])
+        self.assertEqual(order['total_cost'], 3)
+
+        # Items unknown to stock are rejected
+        add_item_response = tu.add_item_to_order(order_id, "00000000-0000-0000-0000-000000000000")
+        self.assertTrue(tu.status_code_is_failure(add_item_response))
+
+    def test_order_batch(self):
+        user_id: str = tu.create_user()['user_id']
+        order_id1: str = tu.create_order(user_id)['order_id']
+        order_id2: str = tu.create_order(user_id)['order_id']
+        item_id1: str = tu.create_item(5)['item_id']
+        item_id2: str = tu.create_item(3)['item_id']
+
+        add_items_response = tu.add_items_to_order(order_id1, {item_id1: 2, item_id2: 3})
+        self.assertTrue(tu.status_code_is_success(add_items_response))
+        order: dict = tu.find_order(order_id1)
+        self.assertEqual(order['quantities'], {item_id1: 2, item_id2: 3})
+        self.assertEqual(order['total_cost'], 19)
+
+        # At most the quantity in the cart is removed
+        remove_items_response = tu.remove_items_from_order(order_id1, {item_id1: 5, item_id2: 1})
+        self.assertTrue(tu.status_code_is_success(remove_items_response))
+        order = tu.find_order(order_id1)
+        self.assertEqual(order['quantities'], {item_id2: 2})
+        self.assertEqual(order['total_cost'], 6)
+
+        add_items_response = tu.add_items_to_order(order_id1, {item_id1: 0})
+        self.assertTrue(tu.status_code_is_failure(add_items_response))
+        add_items_response = tu.add_items_to_order(order_id1, {item_id1: 10 ** 6})
+        self.assertTrue(tu.status_code_is_failure(add_items_response))
+
+        remove_orders_response = tu.remove_orders([order_id1, order_id2])
+        self.assertTrue(tu.status_code_is_success(remove_orders_response.status_code))
+        self.assertEqual(remove_orders_response.json()['removed'], 2)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,3 +1,5 @@
+import json
+
 import requests
 
 ORDER_URL = STOCK_URL = PAYMENT_URL = "http://127.0.0.1:8000"
@@ -10,16 +12,39 @@ def create_item(price: float) -> dict:
     return requests.post(f"{STOCK_URL}/stock/item/create/{price}").json()
 
 
+def create_items(count: int, price: float, stock: int) -> list:
+    response = requests.post(f"{STOCK_URL}/stock/item/create_batch", json={"count": count, "price": price, "stock": stock})
+    return [json.loads(line)['item_id'] for line in response.iter_lines() if line]
+
+
+def restock(csv_body: str) -> list:
+    response = requests.post(f"{STOCK_URL}/stock/restock", data=csv_body, headers={"Content-Type": "text/csv"})
+    return [json.loads(line) for line in response.iter_lines() if line]
+
+
 def find_item(item_id: str) -> dict:
     return requests.get(f"{STOCK_URL}/stock/find/{item_id}").json()
 
 
+def find_items(item_ids: list) -> requests.Response:
+    return requests.post(f"{STOCK_URL}/stock/find_batch", json={"item_ids": item_ids})
+
+
+def set_item_price(item_id: str, price: float) -> int:
+    return requests.post(f"{STOCK_URL}/stock/item/price/{item_id}/{price}").status_code
+
+
+def set_item_shards(item_id: str, shards: int) -> int:
+    return requests.post(f"{STOCK_URL}/stock/item/shards/{item_id}/{shards}").status_code
+
+
 def add_stock(item_id: str, amount: int) -> int:
     return requests.post(f"{STOCK_URL}/stock/add/{item_id}/{amount}").status_code
 
 
-def subtract_stock(item_id: str, amount: int) -> int:
-    return requests.post(f"{STOCK_URL}/stock/subtract/{item_id}/{amount}").status_code
+def subtract_stock(item_id: str, amount: int, idempotency_key: str = None) -> int:
+    headers = {'Idempotency-Key': idempotency_key} if idempotency_key else None
+    return requests.post(f"{STOCK_URL}/stock/subtract/{item_id}/{amount}", headers=headers).status_code
 
 
 ########################################################################################################################
@@ -33,6 +58,11 @@ def create_user() -> dict:
     return requests.post(f"{PAYMENT_URL}/payment/create_user").json()
 
 
+def create_users(count: int, credit: float) -> list:
+    response = requests.post(f"{PAYMENT_URL}/payment/create_user_batch", json={"count": count, "credit": credit})
+    return [json.loads(line)['user_id'] for line in response.iter_lines() if line]
+
+
 def find_user(user_id: str) -> dict:
     return requests.get(f"{PAYMENT_URL}/payment/find_user/{user_id}").json()
 
@@ -52,12 +82,35 @@ def add_item_to_order(order_id: str, item_id: str) -> int:
     return requests.post(f"{ORDER_URL}/orders/addItem/{order_id}/{item_id}").status_code
 
 
+def remove_item_from_order(order_id: str, item_id: str) -> int:
+    return requests.delete(f"{ORDER_URL}/orders/removeItem/{order_id}/{item_id}").status_code
+
+
+def add_items_to_order(order_id: str, items: dict) -> int:
+    return requests.post(f"{ORDER_URL}/orders/addItem_batch/{order_id}", json={"items": items}).status_code
+
+
+def remove_items_from_order(order_id: str, items: dict) -> int:
+    return requests.delete(f"{ORDER_URL}/orders/removeItem_batch/{order_id}", json={"items": items}).status_code
+
+
+def remove_orders(order_ids: list) -> requests.Response:
+    return requests.delete(f"{ORDER_URL}/orders/remove_batch", json={"order_ids": order_ids})
+
+
 def find_order(order_id: str) -> dict:
     return requests.get(f"{ORDER_URL}/orders/find/{order_id}").json()
 
 
-def checkout_order(order_id: str) -> requests.Response:
-    return requests.post(f"{ORDER_URL}/orders/checkout/{order_id}")
+def checkout_order(order_id: str, mode: str = None, asynchronous: bool = False) -> requests.Response:
+    params = {'mode': mode} if mode else {}
+    if asynchronous:
+        params['async'] = 'true'
+    return requests.post(f"{ORDER_URL}/orders/checkout/{order_id}", params=params)
+
+
+def checkout_status(job_id: str) -> dict:
+    return requests.get(f"{ORDER_URL}/orders/checkout_status/{job_id}").json()
 
 
 ########################################################################################################################